@@ -1,22 +1,1186 @@
 import asyncio
+import bisect
+import codecs
+import functools
+import hashlib
+import heapq
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from contextvars import ContextVar, copy_context
 from datetime import datetime, timezone
-from html import unescape
+from html.parser import HTMLParser
 import json
+import math
 import os
+import random
 import re
-from typing import Any, Dict, List, Optional, Union
-from urllib.parse import urlparse
+import time
+import zlib
+import xml.etree.ElementTree as ET
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlsplit, urlunsplit
 
 import httpx
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel, Field
 
-app = FastAPI(title="AppAgent MCP Tool Service", version="1.0.0")
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    open_http_clients()
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    try:
+        yield
+    finally:
+        lag_monitor.cancel()
+        await asyncio.gather(lag_monitor, return_exceptions=True)
+        await close_http_clients()
+
+
+app = FastAPI(title="AppAgent MCP Tool Service", version="1.0.0", lifespan=lifespan)
 SEARX_BASE = os.getenv("SEARX_BASE", "http://searxng:8080")
+# Upstream base URLs; overridable so benchmarks can point them at local stand-ins.
+JINA_BASE = os.getenv("MCP_JINA_BASE", "https://r.jina.ai").rstrip("/")
+GITHUB_API_BASE = os.getenv("MCP_GITHUB_API_BASE", "https://api.github.com").rstrip("/")
+GITHUB_RAW_BASE = os.getenv("MCP_GITHUB_RAW_BASE", "https://raw.githubusercontent.com").rstrip("/")
+HTTP_POOL_MAX_CONNECTIONS = env_int("MCP_HTTP_MAX_CONNECTIONS", 64)
+HTTP_POOL_MAX_KEEPALIVE = env_int("MCP_HTTP_MAX_KEEPALIVE", 16)
+HTTP_POOL_KEEPALIVE_EXPIRY = env_float("MCP_HTTP_KEEPALIVE_EXPIRY", 30.0)
+SEARX_CACHE_TTL = env_float("MCP_SEARX_CACHE_TTL", 300.0)
+SEARX_CACHE_SIZE = env_int("MCP_SEARX_CACHE_SIZE", 512)
+PAGE_CACHE_MAX_BYTES = env_int("MCP_PAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+PAGE_CACHE_TTL = env_float("MCP_PAGE_CACHE_TTL", 900.0)
+PAGE_CACHE_COMPRESS_MIN_BYTES = env_int("MCP_PAGE_CACHE_COMPRESS_MIN_BYTES", 4096)
+GITHUB_TOKEN = os.getenv("MCP_GITHUB_TOKEN") or os.getenv("GITHUB_TOKEN") or ""
+GITHUB_CACHE_SIZE = env_int("MCP_GITHUB_CACHE_SIZE", 256)
+GITHUB_CACHE_TTL = env_float("MCP_GITHUB_CACHE_TTL", 86400.0)
+GITHUB_REVALIDATE_AFTER = env_float("MCP_GITHUB_REVALIDATE_AFTER", 60.0)
+GITHUB_BLOB_CACHE_MAX_BYTES = env_int("MCP_GITHUB_BLOB_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+DIRECT_EXTRACT_SLACK_CHARS = env_int("MCP_DIRECT_EXTRACT_SLACK_CHARS", 2000)
+FETCH_MAX_BYTES = env_int("MCP_FETCH_MAX_BYTES", 2 * 1024 * 1024)
+REQUEST_MAX_BYTES = env_int("MCP_REQUEST_MAX_BYTES", 16 * 1024 * 1024)
+SEARCH_FANOUT_CONCURRENCY = env_int("MCP_SEARCH_FANOUT_CONCURRENCY", 8)
+CONTEXT_FETCH_CONCURRENCY = env_int("MCP_CONTEXT_FETCH_CONCURRENCY", 8)
+BATCH_CONCURRENCY = env_int("MCP_BATCH_CONCURRENCY", 4)
+BM25_K1 = env_float("MCP_BM25_K1", 1.2)
+BM25_B = env_float("MCP_BM25_B", 0.75)
+SIMHASH_MAX_DISTANCE = env_int("MCP_SIMHASH_MAX_DISTANCE", 6)
+SIMHASH_MIN_TERMS = env_int("MCP_SIMHASH_MIN_TERMS", 8)
+MINHASH_THRESHOLD = env_float("MCP_MINHASH_THRESHOLD", 0.8)
+MINHASH_PERMUTATIONS = env_int("MCP_MINHASH_PERMUTATIONS", 64)
+PASSAGE_CHARS = env_int("MCP_PASSAGE_CHARS", 300)
+CONTEXT_BUDGET_TOKENS = env_int("MCP_CONTEXT_BUDGET_TOKENS", 0)
+HEDGE_ENABLED = os.getenv("MCP_HEDGE_FETCH", "true").strip().lower() not in {"0", "false", "no", "off"}
+HEDGE_DELAY = env_float("MCP_HEDGE_DELAY", 2.0)
+HEDGE_P95_THRESHOLD = env_float("MCP_HEDGE_P95_THRESHOLD", 6.0)
+BREAKER_WINDOW = env_int("MCP_BREAKER_WINDOW", 20)
+BREAKER_MIN_CALLS = env_int("MCP_BREAKER_MIN_CALLS", 5)
+BREAKER_ERROR_RATE = env_float("MCP_BREAKER_ERROR_RATE", 0.5)
+BREAKER_SLOW_SECONDS = env_float("MCP_BREAKER_SLOW_SECONDS", 10.0)
+BREAKER_SLOW_RATE = env_float("MCP_BREAKER_SLOW_RATE", 0.8)
+BREAKER_OPEN_SECONDS = env_float("MCP_BREAKER_OPEN_SECONDS", 30.0)
+BREAKER_HALF_OPEN_PROBES = env_int("MCP_BREAKER_HALF_OPEN_PROBES", 2)
+CRAWL_CONCURRENCY = env_int("MCP_CRAWL_CONCURRENCY", 6)
+CRAWL_HOST_CONCURRENCY = env_int("MCP_CRAWL_HOST_CONCURRENCY", 3)
+CRAWL_LINKS_PER_PAGE = env_int("MCP_CRAWL_LINKS_PER_PAGE", 40)
+CRAWL_SPECULATIVE_PAGES = env_int("MCP_CRAWL_SPECULATIVE_PAGES", 1)
+PAGE_LINKS_MAX = env_int("MCP_PAGE_LINKS_MAX", 300)
+SITEMAP_MAX_BYTES = env_int("MCP_SITEMAP_MAX_BYTES", 8 * 1024 * 1024)
+SITEMAP_MAX_FILES = env_int("MCP_SITEMAP_MAX_FILES", 6)
+SITEMAP_MAX_URLS = env_int("MCP_SITEMAP_MAX_URLS", 20000)
+SITEMAP_CACHE_TTL = env_float("MCP_SITEMAP_CACHE_TTL", 3600.0)
+SITEMAP_CACHE_SIZE = env_int("MCP_SITEMAP_CACHE_SIZE", 64)
+SITEMAP_DISCOVERY_TIMEOUT = env_float("MCP_SITEMAP_DISCOVERY_TIMEOUT", 6.0)
+LOOP_LAG_INTERVAL = env_float("MCP_LOOP_LAG_INTERVAL", 0.5)
+RETRY_MAX_ATTEMPTS = env_int("MCP_RETRY_MAX_ATTEMPTS", 2)
+RETRY_BACKOFF = env_float("MCP_RETRY_BACKOFF", 0.25)
+RETRY_BUDGET_RATIO = env_float("MCP_RETRY_BUDGET_RATIO", 0.1)
+RETRY_BUDGET_MIN_PER_SECOND = env_float("MCP_RETRY_BUDGET_MIN_PER_SECOND", 1.0)
 MCP_PROTOCOL_VERSION = "2024-11-05"
 URL_RX = re.compile(r"(https?://[^\s<>'\"`]+)", re.IGNORECASE)
+MARKDOWN_LINK_RX = re.compile(r"(?<!!)\[([^\]\n]{0,300})\]\(\s*<?([^)\s>]+)>?(?:\s+\"[^\"\n]*\")?\s*\)")
+LINK_TOKEN_RX = re.compile(r"[a-z0-9]{2,}")
+RANK_TERM_RX = re.compile(r"\w+", re.UNICODE)
+SENTENCE_END_RX = re.compile(r"(?<=[.!?])\s+")
+APPROX_TOKEN_RX = re.compile(r"\w{1,4}|[^\w\s]", re.UNICODE)
+SEARCH_OPERATOR_RX = re.compile(r"\b(?:site|inurl|intitle|filetype):\S+", re.IGNORECASE)
+LINK_NOISE_RX = re.compile(
+    r"\b(log ?in|log ?out|sign ?in|sign ?up|register|privacy|terms|cookies?|careers|jobs|subscribe|newsletter|"
+    r"share|tweet|facebook|linkedin|twitter|advertis\w*|donate)\b",
+    re.IGNORECASE,
+)
+LINK_SKIP_PREFIXES = ("javascript:", "mailto:", "tel:", "data:", "#")
+LINK_STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "are", "was", "you", "your", "our", "not", "but", "can",
+    "all", "has", "have", "will", "more", "about", "into", "how", "what", "when", "www", "http", "https", "com",
+    "html", "htm", "php", "index", "page", "org", "net",
+}
 GITHUB_REPO_RX = re.compile(r"^/([^/]+)/([^/]+)(?:/|$)")
+TRAILING_URL_PUNCT_RX = re.compile(r"[),.;]+$")
+DUPLICATE_SLASH_RX = re.compile(r"/{2,}")
+TRACKING_PARAM_RX = re.compile(
+    r"^(?:utm_\w+|fbclid|gclid|gclsrc|dclid|msclkid|yclid|igshid|mc_cid|mc_eid|_hsenc|_hsmi|mkt_tok|ref_src|_ga|_gl)$",
+    re.IGNORECASE,
+)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+GITHUB_HOSTS = {"github.com", "raw.githubusercontent.com"}
+GITHUB_FILE_VARIANT_RX = re.compile(r"^/([^/]+)/([^/]+)/(?:blob|raw|tree)/([^/]+)/(.+?)/?$")
+RAW_GITHUB_FILE_RX = re.compile(r"^/([^/]+)/([^/]+)/([^/]+)/(.+?)/?$")
+WHITESPACE_RX = re.compile(r"\s+")
+BINARY_URL_EXT_RX = re.compile(
+    r"\.(png|jpe?g|gif|webp|ico|bmp|tiff?|mp[34]|m4[av]|mov|avi|mkv|webm|wav|flac|ogg|zip|gz|tgz|bz2|xz|7z|rar|tar|"
+    r"iso|dmg|exe|msi|bin|apk|deb|rpm|woff2?|ttf|otf|eot|wasm)$",
+    re.IGNORECASE,
+)
+BINARY_CONTENT_PREFIXES = ("image/", "video/", "audio/", "font/")
+BINARY_CONTENT_TYPES = {
+    "application/octet-stream",
+    "application/pdf",
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-tar",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/x-7z-compressed",
+    "application/x-rar-compressed",
+    "application/vnd.rar",
+    "application/x-msdownload",
+    "application/x-executable",
+    "application/java-archive",
+    "application/wasm",
+    "application/msword",
+    "application/vnd.ms-excel",
+    "application/vnd.ms-powerpoint",
+}
+BINARY_MAGIC = (
+    b"%PDF",
+    b"PK\x03\x04",
+    b"\x89PNG",
+    b"GIF8",
+    b"\xff\xd8\xff",
+    b"\x1f\x8b",
+    b"BZh",
+    b"\xfd7zXZ",
+    b"7z\xbc\xaf",
+    b"Rar!",
+    b"ID3",
+    b"OggS",
+    b"fLaC",
+    b"RIFF",
+    b"\x1aE\xdf\xa3",
+    b"\x7fELF",
+    b"\x00asm",
+    b"wOFF",
+    b"wOF2",
+)
+# Per-request download budget shared by every fetch made while serving one tool call.
+REQUEST_BYTE_BUDGET: ContextVar[Optional[Dict[str, int]]] = ContextVar("request_byte_budget", default=None)
+# Per-/mcp-request memo shared by every item of a JSON-RPC batch, so identical
+# searches and page fetches inside one batch run once even with caches bypassed.
+REQUEST_MEMO: ContextVar[Optional[Dict[Any, tuple]]] = ContextVar("request_memo", default=None)
+# Innermost open span of a debug_timings trace; None (the default) disables tracing.
+TRACE_SPAN: ContextVar[Optional[Dict[str, Any]]] = ContextVar("trace_span", default=None)
+
+
+# One long-lived pooled client per upstream so keep-alive connections are reused
+# across tool calls instead of paying a TCP/TLS handshake on every request.
+UPSTREAM_CLIENT_OPTIONS: Dict[str, Dict[str, Any]] = {
+    "searxng": {"timeout": 20},
+    "jina": {"timeout": 25},
+    "github_api": {
+        "timeout": 20,
+        "headers": {
+            "User-Agent": "appagent-mcp/1.1",
+            **({"Authorization": f"Bearer {GITHUB_TOKEN}"} if GITHUB_TOKEN else {}),
+        },
+    },
+    "github_raw": {"timeout": 25, "headers": {"User-Agent": "appagent-mcp/1.1"}},
+    "direct": {
+        "timeout": 25,
+        "follow_redirects": True,
+        "headers": {
+            "User-Agent": "Mozilla/5.0 (compatible; appagent-mcp/1.3)",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        },
+    },
+}
+HTTP_CLIENTS: Dict[str, httpx.AsyncClient] = {}
+HTTP_POOL_STATS: Dict[str, Dict[str, int]] = {
+    name: {"requests": 0, "errors": 0, "in_flight": 0} for name in UPSTREAM_CLIENT_OPTIONS
+}
+
+
+def pool_limits(upstream: str) -> httpx.Limits:
+    prefix = f"MCP_HTTP_{upstream.upper()}"
+    return httpx.Limits(
+        max_connections=env_int(f"{prefix}_MAX_CONNECTIONS", HTTP_POOL_MAX_CONNECTIONS),
+        max_keepalive_connections=env_int(f"{prefix}_MAX_KEEPALIVE", HTTP_POOL_MAX_KEEPALIVE),
+        keepalive_expiry=HTTP_POOL_KEEPALIVE_EXPIRY,
+    )
+
+
+def build_http_client(upstream: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(limits=pool_limits(upstream), **UPSTREAM_CLIENT_OPTIONS[upstream])
+
+
+def open_http_clients() -> None:
+    for name in UPSTREAM_CLIENT_OPTIONS:
+        if name not in HTTP_CLIENTS or HTTP_CLIENTS[name].is_closed:
+            HTTP_CLIENTS[name] = build_http_client(name)
+
+
+async def close_http_clients() -> None:
+    clients = list(HTTP_CLIENTS.values())
+    HTTP_CLIENTS.clear()
+    await asyncio.gather(*[c.aclose() for c in clients], return_exceptions=True)
+
+
+def http_client(upstream: str) -> httpx.AsyncClient:
+    client = HTTP_CLIENTS.get(upstream)
+    if client is None or client.is_closed:
+        # Lazily (re)create when called outside the app lifespan, e.g. from scripts.
+        client = build_http_client(upstream)
+        HTTP_CLIENTS[upstream] = client
+    return client
+
+
+# Outbound scheduling: every upstream host gets a concurrency semaphore plus a
+# token bucket, configured per upstream via MCP_LIMIT_<UPSTREAM>_{CONCURRENCY,RPS,BURST}.
+OUTBOUND_LIMIT_DEFAULTS: Dict[str, Dict[str, float]] = {
+    "searxng": {"concurrency": 16, "rps": 0, "burst": 0},
+    "jina": {"concurrency": 8, "rps": 10, "burst": 10},
+    "github_api": {"concurrency": 4, "rps": 5, "burst": 10},
+    "github_raw": {"concurrency": 8, "rps": 20, "burst": 20},
+    "direct": {"concurrency": 4, "rps": 5, "burst": 10},
+}
+OUTBOUND_MAX_HOSTS = 512
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        # Takes a token, possibly going negative; returns how long the caller must wait.
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1.0
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def penalize(self, seconds: float) -> None:
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.updated = time.monotonic()
+
+
+class OutboundLimiter:
+    def __init__(self, concurrency: int, rate: float, burst: float) -> None:
+        self.sem = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+        self.bucket = TokenBucket(rate, burst or rate) if rate > 0 else None
+        self.queued = 0
+        self.in_flight = 0
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        started = time.monotonic()
+        self.queued += 1
+        try:
+            if self.sem is not None:
+                await self.sem.acquire()
+            try:
+                delay = self.bucket.reserve() if self.bucket is not None else 0.0
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            except BaseException:
+                if self.sem is not None:
+                    self.sem.release()
+                raise
+        finally:
+            self.queued -= 1
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self.sem is not None:
+                self.sem.release()
+
+
+OUTBOUND_LIMITERS: Dict[tuple, OutboundLimiter] = {}
+
+
+def outbound_limiter(upstream: str, url: str) -> OutboundLimiter:
+    host = (urlparse(url).netloc or "").lower()
+    key = (upstream, host)
+    limiter = OUTBOUND_LIMITERS.get(key)
+    if limiter is None:
+        if len(OUTBOUND_LIMITERS) >= OUTBOUND_MAX_HOSTS:
+            for idle_key in [k for k, v in OUTBOUND_LIMITERS.items() if not v.queued and not v.in_flight]:
+                del OUTBOUND_LIMITERS[idle_key]
+        defaults = OUTBOUND_LIMIT_DEFAULTS[upstream]
+        prefix = f"MCP_LIMIT_{upstream.upper()}"
+        limiter = OutboundLimiter(
+            env_int(f"{prefix}_CONCURRENCY", int(defaults["concurrency"])),
+            env_float(f"{prefix}_RPS", defaults["rps"]),
+            env_float(f"{prefix}_BURST", defaults["burst"]),
+        )
+        OUTBOUND_LIMITERS[key] = limiter
+    return limiter
+
+
+def note_throttled(limiter: OutboundLimiter, res: httpx.Response) -> None:
+    if res.status_code != 429 or limiter.bucket is None:
+        return
+    try:
+        retry_after = float(res.headers.get("retry-after", "") or 1.0)
+    except ValueError:
+        retry_after = 1.0
+    limiter.bucket.penalize(min(30.0, max(0.0, retry_after)))
+
+
+def outbound_stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for (upstream, host), limiter in OUTBOUND_LIMITERS.items():
+        row = out.setdefault(
+            upstream,
+            {"hosts": 0, "queued": 0, "in_flight": 0, "acquired": 0, "wait_ms_avg": 0.0, "wait_ms_max": 0.0, "busy_hosts": {}},
+        )
+        row["hosts"] += 1
+        row["queued"] += limiter.queued
+        row["in_flight"] += limiter.in_flight
+        row["acquired"] += limiter.acquired
+        row["wait_ms_avg"] += limiter.wait_total * 1000
+        row["wait_ms_max"] = max(row["wait_ms_max"], round(limiter.wait_max * 1000, 1))
+        if limiter.queued or limiter.in_flight:
+            row["busy_hosts"][host] = {"queued": limiter.queued, "in_flight": limiter.in_flight}
+    for row in out.values():
+        row["wait_ms_avg"] = round(row["wait_ms_avg"] / row["acquired"], 1) if row["acquired"] else 0.0
+    return out
+
+
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+
+
+# Closed -> open when the rolling window's error or slow-call rate crosses its
+# threshold; open fails fast for BREAKER_OPEN_SECONDS, then half-open lets a few
+# probes through and closes again only if they all succeed.
+class CircuitBreaker:
+    def __init__(self) -> None:
+        self.state = "closed"
+        self.outcomes: deque = deque(maxlen=max(1, BREAKER_WINDOW))
+        self.opened_at = 0.0
+        self.probes = 0
+        self.probe_successes = 0
+        self.opened_count = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < BREAKER_OPEN_SECONDS:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self.probes = 0
+            self.probe_successes = 0
+        if self.state == "half_open":
+            if self.probes >= BREAKER_HALF_OPEN_PROBES:
+                self.rejected += 1
+                return False
+            self.probes += 1
+        return True
+
+    def release(self) -> None:
+        # An admitted call ended without an outcome (e.g. cancelled): free its probe slot.
+        if self.state == "half_open" and self.probes > 0:
+            self.probes -= 1
+
+    def record(self, ok: bool, elapsed: float) -> None:
+        slow = elapsed >= BREAKER_SLOW_SECONDS
+        if self.state == "half_open":
+            if ok and not slow:
+                self.probe_successes += 1
+                if self.probe_successes >= BREAKER_HALF_OPEN_PROBES:
+                    self.state = "closed"
+                    self.outcomes.clear()
+            else:
+                self._trip()
+            return
+        if self.state == "open":
+            return
+        self.outcomes.append((ok, slow))
+        calls = len(self.outcomes)
+        if calls < BREAKER_MIN_CALLS:
+            return
+        failures = sum(1 for good, _ in self.outcomes if not good)
+        slow_calls = sum(1 for _, was_slow in self.outcomes if was_slow)
+        if failures / calls >= BREAKER_ERROR_RATE or slow_calls / calls >= BREAKER_SLOW_RATE:
+            self._trip()
+
+    def _trip(self) -> None:
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.opened_count += 1
+        self.outcomes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        calls = len(self.outcomes)
+        out: Dict[str, Any] = {
+            "state": self.state,
+            "window_calls": calls,
+            "error_rate": round(sum(1 for good, _ in self.outcomes if not good) / calls, 3) if calls else 0.0,
+            "slow_rate": round(sum(1 for _, was_slow in self.outcomes if was_slow) / calls, 3) if calls else 0.0,
+            "opened_count": self.opened_count,
+            "rejected": self.rejected,
+        }
+        if self.state == "open":
+            out["retry_in_seconds"] = round(max(0.0, BREAKER_OPEN_SECONDS - (time.monotonic() - self.opened_at)), 1)
+        return out
+
+
+# Retries are capped globally to a fraction of recent requests (plus a small floor)
+# so retry storms cannot amplify an upstream outage.
+class RetryBudget:
+    def __init__(self, ratio: float, min_per_second: float, window: float = 10.0) -> None:
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._requests: deque = deque()
+        self._retries: deque = deque()
+        self.spent = 0
+        self.denied = 0
+
+    def _trim(self, now: float) -> None:
+        for stamps in (self._requests, self._retries):
+            while stamps and now - stamps[0] > self.window:
+                stamps.popleft()
+
+    def record_request(self) -> None:
+        now = time.monotonic()
+        self._trim(now)
+        self._requests.append(now)
+
+    def try_spend(self) -> bool:
+        now = time.monotonic()
+        self._trim(now)
+        allowed = self.min_per_second * self.window + self.ratio * len(self._requests)
+        if len(self._retries) < allowed:
+            self._retries.append(now)
+            self.spent += 1
+            return True
+        self.denied += 1
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        self._trim(time.monotonic())
+        return {
+            "window_seconds": self.window,
+            "window_requests": len(self._requests),
+            "window_retries": len(self._retries),
+            "spent": self.spent,
+            "denied": self.denied,
+        }
+
+
+CIRCUIT_BREAKERS: Dict[str, CircuitBreaker] = {
+    name: CircuitBreaker() for name in ("searxng", "jina", "github_api", "github_raw")
+}
+RETRY_BUDGET = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND)
+
+
+def can_retry(attempt: int) -> bool:
+    # attempt is the 0-based index of the attempt that just failed;
+    # RETRY_MAX_ATTEMPTS counts every attempt including the first.
+    return attempt + 1 < RETRY_MAX_ATTEMPTS and RETRY_BUDGET.try_spend()
+
+
+def retry_delay(attempt: int) -> float:
+    return min(2.0, RETRY_BACKOFF * (2 ** (attempt - 1))) * random.uniform(0.5, 1.5)
+
+
+# Hand-rolled Prometheus metrics (text exposition format, served by /metrics).
+# Counters are plain dicts keyed by label tuples; histograms keep per-bucket counts.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = tuple(buckets)
+        self.series: Dict[tuple, Dict[str, Any]] = {}
+
+    def observe(self, labels: tuple, value: float) -> None:
+        row = self.series.get(labels)
+        if row is None:
+            row = self.series[labels] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+        row["counts"][bisect.bisect_left(self.buckets, value)] += 1
+        row["sum"] += value
+
+    def samples(self, name: str, label_names: tuple) -> List[tuple]:
+        out: List[tuple] = []
+        for labels, row in sorted(self.series.items()):
+            base = dict(zip(label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), row["counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append((f"{name}_bucket", {**base, "le": le}, cumulative))
+            out.append((f"{name}_sum", base, row["sum"]))
+            out.append((f"{name}_count", base, cumulative))
+        return out
+
+
+TOOL_REQUESTS: Dict[tuple, int] = {}
+TOOL_IN_FLIGHT: Dict[str, int] = {}
+TOOL_LATENCY = Histogram(LATENCY_BUCKETS)
+STAGE_LATENCY = Histogram(LATENCY_BUCKETS)
+UPSTREAM_REQUESTS: Dict[tuple, int] = {}
+UPSTREAM_BYTES: Dict[str, int] = {}
+UPSTREAM_LATENCY = Histogram(LATENCY_BUCKETS)
+EVENT_LOOP_LAG = Histogram(LOOP_LAG_BUCKETS)
+EVENT_LOOP_LAG_LAST = {"seconds": 0.0}
+
+
+def count_metric(table: Dict[Any, int], key: Any, value: int = 1) -> None:
+    table[key] = table.get(key, 0) + value
+
+
+# debug_timings tracing: spans are plain dicts nested under the caller's span.
+# Tasks inherit the span that was current when they were created, so gathered
+# fetches land under the stage that scheduled them. Every helper is a single
+# ContextVar lookup when tracing is off.
+@contextmanager
+def trace_span(name: str, **attrs: Any):
+    parent = TRACE_SPAN.get()
+    if parent is None:
+        yield None
+        return
+    span = {"name": name, **attrs, "_started": time.monotonic(), "_origin": parent["_origin"], "children": []}
+    parent["children"].append(span)
+    token = TRACE_SPAN.set(span)
+    try:
+        yield span
+    finally:
+        span["duration_ms"] = round((time.monotonic() - span["_started"]) * 1000, 2)
+        TRACE_SPAN.reset(token)
+
+
+def trace_event(name: str, started: float, **attrs: Any) -> None:
+    parent = TRACE_SPAN.get()
+    if parent is None:
+        return
+    span = {"name": name, **attrs, "_started": started, "duration_ms": round((time.monotonic() - started) * 1000, 2)}
+    parent["children"].append(span)
+
+
+def span_note(**attrs: Any) -> None:
+    span = TRACE_SPAN.get()
+    if span is not None:
+        span.update(attrs)
+
+
+def traced(name: str) -> Any:
+    def wrap(fn: Any) -> Any:
+        if asyncio.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def run_async(*args: Any, **kwargs: Any) -> Any:
+                if TRACE_SPAN.get() is None:
+                    return await fn(*args, **kwargs)
+                with trace_span(name):
+                    return await fn(*args, **kwargs)
+
+            return run_async
+
+        @functools.wraps(fn)
+        def run(*args: Any, **kwargs: Any) -> Any:
+            if TRACE_SPAN.get() is None:
+                return fn(*args, **kwargs)
+            with trace_span(name):
+                return fn(*args, **kwargs)
+
+        return run
+
+    return wrap
+
+
+def trace_output(span: Dict[str, Any], origin: float) -> Dict[str, Any]:
+    out = {k: v for k, v in span.items() if not k.startswith("_") and k != "children"}
+    out["start_ms"] = round((span["_started"] - origin) * 1000, 2)
+    if "duration_ms" not in span:
+        # Still running (e.g. an abandoned single-flight leader) when the trace closed.
+        out["unfinished"] = True
+    children = sorted(span.get("children") or [], key=lambda child: child["_started"])
+    if children:
+        out["children"] = [trace_output(child, origin) for child in children]
+    return out
+
+
+def trace_summary(root: Dict[str, Any]) -> Dict[str, Any]:
+    upstreams: Dict[str, Dict[str, Any]] = {}
+    cache = {"hit": 0, "miss": 0}
+    stack = list(root["children"])
+    while stack:
+        span = stack.pop()
+        stack.extend(span.get("children") or [])
+        if span["name"] == "upstream":
+            row = upstreams.setdefault(span["upstream"], {"calls": 0, "errors": 0, "bytes": 0, "ms": 0.0})
+            row["calls"] += 1
+            row["bytes"] += span.get("bytes", 0)
+            row["ms"] = round(row["ms"] + span["duration_ms"], 2)
+            if not str(span.get("status", "")).isdigit() or int(span["status"]) >= 400:
+                row["errors"] += 1
+        result = span.get("cache")
+        if result in ("hit", "fresh", "revalidated", "blob_sha_hits"):
+            cache["hit"] += 1
+        elif result is not None:
+            cache["miss"] += 1
+    return {"upstream": dict(sorted(upstreams.items())), "cache": cache}
+
+
+def observe_upstream(upstream: str, status: str, started: float, size: int, url: str = "", attempt: int = 0) -> None:
+    elapsed = time.monotonic() - started
+    count_metric(UPSTREAM_REQUESTS, (upstream, status))
+    count_metric(UPSTREAM_BYTES, upstream, size)
+    UPSTREAM_LATENCY.observe((upstream,), elapsed)
+    trace_event("upstream", started, upstream=upstream, url=url, status=status, bytes=size, attempt=attempt + 1)
+
+
+@asynccontextmanager
+async def observe_stage(stage: str, **attrs: Any):
+    started = time.monotonic()
+    try:
+        with trace_span(stage, **attrs) as span:
+            yield span
+    finally:
+        STAGE_LATENCY.observe((stage,), time.monotonic() - started)
+
+
+def instrumented_tool(name: str) -> Any:
+    def wrap(fn: Any) -> Any:
+        @functools.wraps(fn)
+        async def run(payload: Any) -> Any:
+            count_metric(TOOL_IN_FLIGHT, name)
+            started = time.monotonic()
+            outcome = "error"
+            root = None
+            token = None
+            if getattr(payload, "debug_timings", False):
+                root = {"name": name, "_started": started, "_origin": started, "children": []}
+                token = TRACE_SPAN.set(root)
+            try:
+                result = await fn(payload)
+                if root is not None:
+                    # Measured on the payload before the trace is attached; the
+                    # framework's own encoding of the response costs about the same.
+                    with trace_span("serialize") as span:
+                        span["bytes"] = len(json.dumps(result, ensure_ascii=False).encode("utf-8"))
+                    root["duration_ms"] = round((time.monotonic() - started) * 1000, 2)
+                    result["debug_timings"] = {
+                        "total_ms": root["duration_ms"],
+                        **trace_summary(root),
+                        "spans": [trace_output(child, started) for child in sorted(root["children"], key=lambda c: c["_started"])],
+                    }
+                outcome = "ok"
+                return result
+            finally:
+                if token is not None:
+                    TRACE_SPAN.reset(token)
+                TOOL_IN_FLIGHT[name] -= 1
+                count_metric(TOOL_REQUESTS, (name, outcome))
+                TOOL_LATENCY.observe((name,), time.monotonic() - started)
+
+        return run
+
+    return wrap
+
+
+async def monitor_event_loop_lag() -> None:
+    # Sleeps a fixed interval and records how late the loop wakes up; sustained lag
+    # means CPU-bound work (parsing, ranking) is starving concurrent requests.
+    loop = asyncio.get_running_loop()
+    interval = max(0.01, LOOP_LAG_INTERVAL)
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        EVENT_LOOP_LAG_LAST["seconds"] = lag
+        EVENT_LOOP_LAG.observe((), lag)
+
+
+@asynccontextmanager
+async def upstream_stream(upstream: str, url: str, **kwargs: Any):
+    # Single choke point for outbound calls: circuit breaker admission, per-host
+    # scheduling, pool stats and budgeted retries on transient failures. Retries
+    # only happen before the response is handed to the caller.
+    limiter = outbound_limiter(upstream, url)
+    breaker = CIRCUIT_BREAKERS.get(upstream)
+    stats = HTTP_POOL_STATS[upstream]
+    RETRY_BUDGET.record_request()
+    attempt = 0
+    while True:
+        if breaker is not None and not breaker.allow():
+            count_metric(UPSTREAM_REQUESTS, (upstream, "circuit_open"))
+            trace_event("upstream", time.monotonic(), upstream=upstream, url=url, status="circuit_open", bytes=0, attempt=attempt + 1)
+            raise HTTPException(status_code=503, detail=f"{upstream} circuit open")
+        recorded = False
+        retry = False
+        try:
+            async with limiter.slot():
+                stats["requests"] += 1
+                stats["in_flight"] += 1
+                started = time.monotonic()
+                try:
+                    async with http_client(upstream).stream("GET", url, **kwargs) as res:
+                        try:
+                            note_throttled(limiter, res)
+                            ok = res.status_code not in TRANSIENT_STATUS
+                            if breaker is not None:
+                                breaker.record(ok, time.monotonic() - started)
+                            recorded = True
+                            if not ok and can_retry(attempt):
+                                retry = True
+                            else:
+                                yield res
+                        finally:
+                            # Latency covers the body as consumed by the caller.
+                            observe_upstream(upstream, str(res.status_code), started, res.num_bytes_downloaded, url, attempt)
+                except httpx.PoolTimeout:
+                    # Local pool saturation, not an upstream fault: no breaker
+                    # outcome (the admission is released below) and no retry.
+                    observe_upstream(upstream, "pool_timeout", started, 0, url, attempt)
+                    stats["errors"] += 1
+                    raise
+                except httpx.TransportError as err:
+                    if not recorded:
+                        observe_upstream(upstream, "error", started, 0, url, attempt)
+                    stats["errors"] += 1
+                    if recorded:
+                        raise
+                    if breaker is not None:
+                        breaker.record(False, time.monotonic() - started)
+                    recorded = True
+                    # A timed-out attempt already cost a full timeout; retrying
+                    # would multiply it, so timeouts only feed the breaker.
+                    if isinstance(err, httpx.TimeoutException) or not can_retry(attempt):
+                        raise
+                    retry = True
+                except httpx.HTTPError:
+                    stats["errors"] += 1
+                    raise
+                finally:
+                    stats["in_flight"] -= 1
+        finally:
+            if breaker is not None and not recorded:
+                breaker.release()
+        if not retry:
+            return
+        attempt += 1
+        await asyncio.sleep(retry_delay(attempt))
+
+
+async def upstream_get(upstream: str, url: str, **kwargs: Any) -> httpx.Response:
+    async with upstream_stream(upstream, url, **kwargs) as res:
+        await res.aread()
+    return res
+
+
+class FetchSkipped(Exception):
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+async def request_memo(key: Any, factory: Any) -> Any:
+    memo = REQUEST_MEMO.get()
+    if memo is None:
+        return await factory()
+    exhausted = request_budget_exhausted()
+    entry = memo.get((key, exhausted))
+    if entry is None:
+        entry = memo[(key, exhausted)] = start_shared(factory, exhausted)
+        entry[0].add_done_callback(lambda f: f.cancelled() or f.exception())
+    else:
+        span_note(memo="shared")
+    fut, budget = entry
+    try:
+        return await asyncio.shield(fut)
+    finally:
+        charge_shared(budget)
+
+
+def begin_request_budget() -> None:
+    REQUEST_BYTE_BUDGET.set({"limit": REQUEST_MAX_BYTES, "remaining": REQUEST_MAX_BYTES})
+
+
+def request_budget_exhausted() -> bool:
+    budget = REQUEST_BYTE_BUDGET.get()
+    return budget is not None and budget["remaining"] <= 0
+
+
+# Work shared between callers (single-flight, batch memo) runs under its own
+# byte budget rather than the first caller's, so one caller's exhausted budget
+# cannot fail or truncate the fetch for everyone else. Callers with an exhausted
+# budget coalesce separately onto work that may not download anything. Each
+# waiter is charged the bytes the shared work downloaded once it has finished.
+def start_shared(factory: Any, exhausted: bool = False) -> tuple:
+    size = 0 if exhausted else REQUEST_MAX_BYTES
+    budget = {"limit": size, "remaining": size}
+    ctx = copy_context()
+    ctx.run(REQUEST_BYTE_BUDGET.set, budget)
+    return asyncio.get_running_loop().create_task(factory(), context=ctx), budget
+
+
+def charge_shared(budget: Dict[str, int]) -> None:
+    mine = REQUEST_BYTE_BUDGET.get()
+    if mine is not None and mine is not budget:
+        mine["remaining"] = max(0, mine["remaining"] - (budget["limit"] - budget["remaining"]))
+
+
+def binary_url_reason(url: str) -> Optional[str]:
+    m = BINARY_URL_EXT_RX.search(urlparse(url).path or "")
+    return f"binary url extension: .{m.group(1).lower()}" if m else None
+
+
+def content_skip_reason(headers: httpx.Headers) -> Optional[str]:
+    content_type = str(headers.get("content-type", "")).split(";", 1)[0].strip().lower()
+    if content_type.startswith(BINARY_CONTENT_PREFIXES) or content_type in BINARY_CONTENT_TYPES:
+        return f"non-text content-type: {content_type}"
+    try:
+        length = int(headers.get("content-length", "") or -1)
+    except ValueError:
+        length = -1
+    if length > FETCH_MAX_BYTES:
+        return f"content-length {length} exceeds fetch cap {FETCH_MAX_BYTES}"
+    return None
+
+
+def sniff_binary_reason(head: bytes) -> Optional[str]:
+    if head.startswith(BINARY_MAGIC) or head[4:8] == b"ftyp":
+        return "binary content sniffed"
+    if b"\x00" in head[:1024]:
+        return "binary content sniffed"
+    return None
+
+
+async def iter_capped_body(res: httpx.Response, state: Dict[str, Any]) -> AsyncIterator[bytes]:
+    # Yields the (decoded) body while enforcing the per-fetch and per-request byte
+    # budgets; sets state["truncated"] when a cap cuts the body short.
+    budget = REQUEST_BYTE_BUDGET.get()
+    if budget is not None and budget["remaining"] <= 0:
+        raise FetchSkipped("request byte budget exhausted")
+    received = 0
+    sniffed = False
+    async for chunk in res.aiter_bytes():
+        if not sniffed:
+            reason = sniff_binary_reason(chunk[:1024])
+            if reason:
+                raise FetchSkipped(reason)
+            sniffed = True
+        allowed = FETCH_MAX_BYTES - received
+        cap_reason = "fetch_byte_cap"
+        if budget is not None and budget["remaining"] < allowed:
+            allowed = budget["remaining"]
+            cap_reason = "request_byte_budget"
+        if len(chunk) >= allowed:
+            chunk = chunk[: max(0, allowed)]
+            state["truncated"] = cap_reason
+        received += len(chunk)
+        if budget is not None:
+            budget["remaining"] -= len(chunk)
+        state["bytes"] = received
+        if chunk:
+            yield chunk
+        if state.get("truncated"):
+            return
+
+
+async def read_capped_text(res: httpx.Response) -> Dict[str, Any]:
+    reason = content_skip_reason(res.headers)
+    if reason:
+        raise FetchSkipped(reason)
+    state: Dict[str, Any] = {"truncated": None, "bytes": 0}
+    decoder = codecs.getincrementaldecoder(res.encoding or "utf-8")(errors="replace")
+    parts: List[str] = []
+    async with aclosing(iter_capped_body(res, state)) as body:
+        async for chunk in body:
+            parts.append(decoder.decode(chunk))
+    parts.append(decoder.decode(b"", final=True))
+    return {"text": "".join(parts), "truncated": state["truncated"], "bytes": state["bytes"]}
+
+
+def http_pool_stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for name, counters in HTTP_POOL_STATS.items():
+        row: Dict[str, Any] = dict(counters)
+        client = HTTP_CLIENTS.get(name)
+        # httpx does not expose pool occupancy publicly; read it from httpcore when available.
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        connections = list(getattr(pool, "connections", []) or [])
+        row["open"] = client is not None and not client.is_closed
+        row["connections"] = len(connections)
+        row["idle_connections"] = sum(1 for c in connections if c.is_idle())
+        limits = pool_limits(name)
+        row["max_connections"] = limits.max_connections
+        row["max_keepalive_connections"] = limits.max_keepalive_connections
+        out[name] = row
+    return out
+
+
+# Bounded LRU mapping whose entries also expire after a TTL.
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = max(0, int(maxsize))
+        self.ttl = float(ttl)
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Any) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+SEARX_CACHE = TTLCache(SEARX_CACHE_SIZE, SEARX_CACHE_TTL)
+
+
+# LRU text cache bounded by total stored bytes rather than entry count. Large
+# entries are kept zlib-compressed; each entry carries its own expiry.
+class ByteBudgetCache:
+    ENTRY_OVERHEAD = 128
+
+    def __init__(self, max_bytes: int, ttl: float, compress_min_bytes: int) -> None:
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl = float(ttl)
+        self.compress_min_bytes = max(0, int(compress_min_bytes))
+        self._data: "OrderedDict[Any, Dict[str, Any]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, key: Any) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry["size"]
+
+    def get(self, key: Any) -> Optional[Dict[str, Any]]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry["expires_at"] <= time.monotonic():
+            self._drop(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        data = zlib.decompress(entry["data"]) if entry["compressed"] else entry["data"]
+        return {**entry["meta"], "text": data.decode("utf-8")}
+
+    def set(self, key: Any, text: str, ttl: Optional[float] = None, **meta: Any) -> None:
+        if self.max_bytes <= 0 or self.ttl <= 0:
+            return
+        data = str(text or "").encode("utf-8")
+        compressed = False
+        if len(data) >= self.compress_min_bytes:
+            packed = zlib.compress(data, 6)
+            if len(packed) < len(data):
+                data = packed
+                compressed = True
+        size = len(data) + len(str(key)) + sum(len(str(v)) for v in meta.values()) + self.ENTRY_OVERHEAD
+        self._drop(key)
+        if size > self.max_bytes:
+            return
+        while self._data and self.bytes + size > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.bytes -= evicted["size"]
+            self.evictions += 1
+        self._data[key] = {
+            "data": data,
+            "compressed": compressed,
+            "size": size,
+            "expires_at": time.monotonic() + (self.ttl if ttl is None else ttl),
+            "meta": meta,
+        }
+        self.bytes += size
+
+    def touch(self, key: Any, ttl: Optional[float] = None, **meta: Any) -> None:
+        entry = self._data.get(key)
+        if entry is None:
+            return
+        entry["expires_at"] = time.monotonic() + (self.ttl if ttl is None else ttl)
+        entry["meta"].update(meta)
+        self._data.move_to_end(key)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "compressed_entries": sum(1 for e in self._data.values() if e["compressed"]),
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Rolling per-host latency samples; failures and lost races count as infinitely slow
+# so a host the mirror cannot serve quickly is hedged immediately next time.
+class HostLatencyTracker:
+    def __init__(self, window: int = 50, min_samples: int = 5) -> None:
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: "OrderedDict[str, deque]" = OrderedDict()
+
+    def record(self, host: str, seconds: float) -> None:
+        samples = self._samples.get(host)
+        if samples is None:
+            samples = self._samples[host] = deque(maxlen=self.window)
+            while len(self._samples) > 1024:
+                self._samples.popitem(last=False)
+        samples.append(seconds)
+
+    def p95(self, host: str) -> Optional[float]:
+        samples = self._samples.get(host)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+MIRROR_LATENCY = HostLatencyTracker()
+PAGE_CACHE = ByteBudgetCache(PAGE_CACHE_MAX_BYTES, PAGE_CACHE_TTL, PAGE_CACHE_COMPRESS_MIN_BYTES)
+# Repo info and trees are revalidated with ETags; blob contents are keyed by blob SHA
+# so an unchanged file is never downloaded twice, even after the branch moves.
+GITHUB_META_CACHE = TTLCache(GITHUB_CACHE_SIZE, GITHUB_CACHE_TTL)
+SITEMAP_CACHE = TTLCache(SITEMAP_CACHE_SIZE, SITEMAP_CACHE_TTL)
+GITHUB_BLOB_CACHE = ByteBudgetCache(GITHUB_BLOB_CACHE_MAX_BYTES, GITHUB_CACHE_TTL, PAGE_CACHE_COMPRESS_MIN_BYTES)
+GITHUB_CACHE_STATS: Dict[str, int] = {"fresh": 0, "revalidated": 0, "fetched": 0, "stale": 0, "blob_sha_hits": 0}
+
+
+def note_github_cache(result: str) -> None:
+    GITHUB_CACHE_STATS[result] += 1
+    span_note(cache=result)
+
+
+# Coalesces concurrent identical upstream calls onto one shared task. Waiters are
+# shielded, so a disconnecting caller never cancels the request for the others;
+# the shared task is only cancelled once every waiter has gone away.
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls: Dict[Any, Dict[str, Any]] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    async def do(self, key: Any, factory: Any) -> Any:
+        exhausted = request_budget_exhausted()
+        key = (key, exhausted)
+        call = self._calls.get(key)
+        if call is None:
+            task, budget = start_shared(factory, exhausted)
+            call = {"task": task, "budget": budget, "waiters": 0}
+            self._calls[key] = call
+            task.add_done_callback(lambda t, k=key, c=call: self._finish(k, c, t))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        task = call["task"]
+        call["waiters"] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            charge_shared(call["budget"])
+            call["waiters"] -= 1
+            if call["waiters"] <= 0 and not task.done():
+                task.cancel()
+                self.abandoned += 1
+
+    def _finish(self, key: Any, call: Dict[str, Any], task: "asyncio.Future[Any]") -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every waiter already left.
+            task.exception()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
+
+
+SINGLE_FLIGHTS: Dict[str, SingleFlight] = {
+    "searx": SingleFlight(),
+    "jina": SingleFlight(),
+    "github_repo": SingleFlight(),
+    "github_raw": SingleFlight(),
+    "sitemap": SingleFlight(),
+}
 
 
 class SearchInput(BaseModel):
@@ -28,12 +1192,18 @@ class SearchInput(BaseModel):
     context_max_urls: int = Field(2, ge=0, le=10)
     context_max_chars: int = Field(1400, ge=500, le=6000)
     strict_repo_only: bool = False
+    no_cache: bool = False
+    budget_tokens: Optional[int] = Field(None, ge=100, le=100000)
+    debug_timings: bool = False
 
 
 class FetchInput(BaseModel):
     url: str
     max_urls: int = Field(5, ge=1, le=20)
     max_chars_per_url: int = Field(2200, ge=500, le=8000)
+    query: Optional[str] = None
+    budget_tokens: Optional[int] = Field(None, ge=100, le=100000)
+    debug_timings: bool = False
 
 
 class SmartFetchInput(BaseModel):
@@ -41,6 +1211,13 @@ class SmartFetchInput(BaseModel):
     max_urls: int = Field(4, ge=1, le=12)
     max_chars_per_url: int = Field(2200, ge=500, le=8000)
     allow_external: bool = False
+    max_depth: int = Field(2, ge=1, le=3)
+    max_pages: Optional[int] = Field(None, ge=1, le=60)
+    time_budget_seconds: float = Field(20.0, ge=1.0, le=60.0)
+    query: Optional[str] = None
+    use_sitemap: bool = False
+    budget_tokens: Optional[int] = Field(None, ge=100, le=100000)
+    debug_timings: bool = False
 
 
 class ToolCall(BaseModel):
@@ -58,6 +1235,10 @@ class DeepSearchInput(BaseModel):
     context_max_urls: int = Field(5, ge=0, le=12)
     context_max_chars: int = Field(1800, ge=500, le=6000)
     strict_repo_only: bool = True
+    no_cache: bool = False
+    rrf_k: int = Field(60, ge=1, le=1000)
+    budget_tokens: Optional[int] = Field(None, ge=100, le=100000)
+    debug_timings: bool = False
 
 
 class JsonRpcRequest(BaseModel):
@@ -67,6 +1248,18 @@ class JsonRpcRequest(BaseModel):
     params: Dict[str, Any] = Field(default_factory=dict)
 
 
+async def run_limited(limiter: Optional[asyncio.Semaphore], coro: Any) -> Any:
+    if limiter is None:
+        return await coro
+    async with limiter:
+        return await coro
+
+
+async def gather_bounded(coros: List[Any], limit: int) -> List[Any]:
+    sem = asyncio.Semaphore(max(1, int(limit)))
+    return await asyncio.gather(*[run_limited(sem, c) for c in coros], return_exceptions=True)
+
+
 def normalize_results(results: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
     out: List[Dict[str, Any]] = []
     for row in results[:limit]:
@@ -80,19 +1273,45 @@ def normalize_results(results: List[Dict[str, Any]], limit: int) -> List[Dict[st
     return out
 
 
-async def searx_search(query: str, categories: str, limit: int) -> List[Dict[str, Any]]:
-    params = {
-        "q": query,
-        "format": "json",
-        "categories": categories,
-        "language": "auto",
-    }
-    async with httpx.AsyncClient(timeout=20) as client:
-        res = await client.get(f"{SEARX_BASE}/search", params=params)
+def searx_cache_key(query: str, categories: str, language: str) -> tuple:
+    q = re.sub(r"\s+", " ", str(query or "")).strip().casefold()
+    cats = ",".join(sorted({c.strip().lower() for c in str(categories or "").split(",") if c.strip()}))
+    return (q, cats, str(language or "auto").strip().lower())
+
+
+async def searx_search(
+    query: str,
+    categories: str,
+    limit: int,
+    language: str = "auto",
+    bypass_cache: bool = False,
+) -> List[Dict[str, Any]]:
+    key = searx_cache_key(query, categories, language)
+    rows = None if bypass_cache else SEARX_CACHE.get(key)
+    if rows is not None:
+        trace_event("searx_search", time.monotonic(), query=query, lane=categories, cache="hit")
+
+    async def fetch_rows() -> List[Dict[str, Any]]:
+        params = {
+            "q": query,
+            "format": "json",
+            "categories": categories,
+            "language": language,
+        }
+        res = await upstream_get("searxng", f"{SEARX_BASE}/search", params=params)
         if res.status_code != 200:
             raise HTTPException(status_code=502, detail=f"searxng error: {res.status_code}")
-        data = res.json()
-    return normalize_results(data.get("results", []), limit)
+        raw_rows = res.json().get("results", []) or []
+        # Cache the full list so later calls with a smaller limit are served by slicing.
+        fetched = normalize_results(raw_rows, len(raw_rows))
+        SEARX_CACHE.set(key, fetched)
+        return fetched
+
+    if rows is None:
+        async with observe_stage("searx_search", query=query, lane=categories, cache="miss"):
+            rows = await request_memo(("searx", key), lambda: SINGLE_FLIGHTS["searx"].do(key, fetch_rows))
+    # Callers annotate rows in place (e.g. matched_query), so never hand out cached dicts.
+    return [dict(row) for row in rows[:limit]]
 
 
 def validate_http_url(url: str) -> None:
@@ -102,7 +1321,45 @@ def validate_http_url(url: str) -> None:
 
 
 def normalize_url(url: str) -> str:
-    return re.sub(r"[),.;]+$", "", str(url or "").strip())
+    return TRAILING_URL_PUNCT_RX.sub("", str(url or "").strip())
+
+
+# Canonical URL keys for dedup, cache and single-flight keys: scheme folded to
+# https, host lowercased without "www." or a default port, duplicate and trailing
+# slashes dropped, tracking parameters removed and the rest sorted, fragment
+# removed. Path case is preserved. Keys identify pages; fetch the original URL.
+def canonical_host(host: str) -> str:
+    host = (host or "").lower().rstrip(".")
+    return host[4:] if host.startswith("www.") else host
+
+
+def canonical_url(url: str) -> str:
+    u = normalize_url(url)
+    try:
+        p = urlsplit(u)
+        port = p.port
+    except ValueError:
+        return u
+    scheme = (p.scheme or "").lower()
+    if scheme not in DEFAULT_PORTS or not p.hostname:
+        return u
+    host = canonical_host(p.hostname)
+    if ":" in host:
+        host = f"[{host}]"
+    # The key folds the scheme to https, so a port is only dropped when it is the
+    # https default; http://h:443 and https://h then share a key, http://h:80 too.
+    if port and port not in (DEFAULT_PORTS[scheme], DEFAULT_PORTS["https"]):
+        host = f"{host}:{port}"
+    path = DUPLICATE_SLASH_RX.sub("/", p.path or "/")
+    if len(path) > 1:
+        path = path.rstrip("/") or "/"
+    params = sorted((k, v) for k, v in parse_qsl(p.query, keep_blank_values=True) if not TRACKING_PARAM_RX.match(k))
+    return urlunsplit(("https", host, path, urlencode(params), ""))
+
+
+def result_key(row: Dict[str, Any]) -> str:
+    url = str(row.get("url") or "").strip()
+    return canonical_url(url) if url else str(row.get("title") or "").strip().lower()
 
 
 def unique_urls(urls: List[str]) -> List[str]:
@@ -116,7 +1373,7 @@ def unique_urls(urls: List[str]) -> List[str]:
             validate_http_url(u)
         except Exception:
             continue
-        key = u.lower()
+        key = canonical_url(u)
         if key in seen:
             continue
         seen.add(key)
@@ -138,7 +1395,7 @@ def parse_github_repo(url: str) -> Optional[Dict[str, str]]:
         p = urlparse(url)
     except Exception:
         return None
-    if p.netloc.lower() not in {"github.com", "www.github.com"}:
+    if canonical_host(p.hostname or "") != "github.com":
         return None
     m = GITHUB_REPO_RX.match(p.path or "")
     if not m:
@@ -185,16 +1442,28 @@ def github_scope_urls(urls: List[str]) -> List[Dict[str, str]]:
     return out
 
 
+def github_scope_index(scopes: List[Dict[str, str]]) -> Dict[str, set]:
+    repos = {(s["owner"].lower(), s["repo"].lower().removesuffix(".git")) for s in scopes}
+    return {host: repos for host in GITHUB_HOSTS}
+
+
+def in_github_scope(url: str, index: Dict[str, set]) -> bool:
+    try:
+        p = urlsplit(str(url or ""))
+        repos = index.get(canonical_host(p.hostname or ""))
+    except ValueError:
+        return False
+    if not repos:
+        return False
+    m = GITHUB_REPO_RX.match(p.path or "")
+    return bool(m) and (m.group(1).lower(), m.group(2).lower().removesuffix(".git")) in repos
+
+
 def filter_results_by_github_scope(results: List[Dict[str, Any]], scopes: List[Dict[str, str]]) -> List[Dict[str, Any]]:
     if not scopes:
         return results
-    prefixes = [f"https://github.com/{s['owner']}/{s['repo']}".lower() for s in scopes]
-    out: List[Dict[str, Any]] = []
-    for row in results:
-        u = str(row.get("url", "")).lower()
-        if any(u.startswith(pref) for pref in prefixes):
-            out.append(row)
-    return out
+    index = github_scope_index(scopes)
+    return [row for row in results if in_github_scope(str(row.get("url", "")), index)]
 
 
 def build_repo_scoped_queries(base_queries: List[str], scopes: List[Dict[str, str]]) -> List[str]:
@@ -218,7 +1487,7 @@ def merge_result_rows(rows: List[Dict[str, Any]], limit: int) -> List[Dict[str,
     out: List[Dict[str, Any]] = []
     seen = set()
     for row in rows:
-        key = str(row.get("url") or row.get("title") or "").strip().lower()
+        key = result_key(row)
         if not key or key in seen:
             continue
         seen.add(key)
@@ -228,9 +1497,149 @@ def merge_result_rows(rows: List[Dict[str, Any]], limit: int) -> List[Dict[str,
     return out
 
 
+def rank_terms(text: str) -> List[str]:
+    return [t for t in RANK_TERM_RX.findall(SEARCH_OPERATOR_RX.sub(" ", str(text or "")).casefold()) if len(t) > 1 or t.isdigit()]
+
+
+@traced("bm25")
+def bm25_scores(rows: List[Dict[str, Any]], queries: List[str]) -> List[float]:
+    # Okapi BM25 of title+content against each query; a row keeps its best score.
+    # Term statistics (df, idf, avgdl, per-row tf) are built once per candidate set.
+    docs: List[Dict[str, int]] = []
+    lengths: List[int] = []
+    df: Dict[str, int] = {}
+    for row in rows:
+        terms = rank_terms(f"{row.get('title') or ''} {row.get('content') or ''}")
+        tf: Dict[str, int] = {}
+        for t in terms:
+            tf[t] = tf.get(t, 0) + 1
+        for t in tf:
+            df[t] = df.get(t, 0) + 1
+        docs.append(tf)
+        lengths.append(len(terms))
+    n = len(docs)
+    if not n:
+        return []
+    avgdl = (sum(lengths) / n) or 1.0
+    idf = {t: math.log(1.0 + (n - d + 0.5) / (d + 0.5)) for t, d in df.items()}
+    norms = [BM25_K1 * (1.0 - BM25_B + BM25_B * dl / avgdl) for dl in lengths]
+    query_terms = [sorted({t for t in rank_terms(q) if t in idf}) for q in queries]
+    scores: List[float] = []
+    for tf, norm in zip(docs, norms):
+        best = 0.0
+        for terms in query_terms:
+            score = 0.0
+            for t in terms:
+                f = tf.get(t)
+                if f:
+                    score += idf[t] * f * (BM25_K1 + 1.0) / (f + norm)
+            best = max(best, score)
+        scores.append(best)
+    return scores
+
+
+MINHASH_PRIME = (1 << 61) - 1
+
+def minhash_params(count: int) -> List[tuple]:
+    # Fixed seed so signatures are comparable across requests and processes.
+    rng = random.Random(0x5EED)
+    return [(rng.randrange(1, MINHASH_PRIME), rng.randrange(0, MINHASH_PRIME)) for _ in range(max(1, count))]
+
+
+MINHASH_PARAMS = minhash_params(MINHASH_PERMUTATIONS)
+
+
+def hash64(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def github_variant_key(url: str) -> Optional[tuple]:
+    # github.com/o/r/{blob,raw,tree}/ref/path and raw.githubusercontent.com/o/r/ref/path
+    # name the same file; collapse them to one key.
+    try:
+        p = urlparse(url)
+    except ValueError:
+        return None
+    host = canonical_host(p.hostname or "")
+    if host == "github.com":
+        m = GITHUB_FILE_VARIANT_RX.match(p.path or "")
+    elif host == "raw.githubusercontent.com":
+        m = RAW_GITHUB_FILE_RX.match(p.path or "")
+    else:
+        return None
+    if not m:
+        return None
+    owner, repo, ref, path = m.groups()
+    return ("github", owner.lower(), repo.lower(), ref, path)
+
+
+def simhash(text: str) -> Optional[int]:
+    terms = rank_terms(text)
+    if len(terms) < max(1, SIMHASH_MIN_TERMS):
+        return None
+    weights = [0] * 64
+    for shingle in zip(terms, terms[1:]):
+        h = hash64(" ".join(shingle))
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def minhash_signature(text: str) -> Optional[List[int]]:
+    terms = rank_terms(text)
+    shingles = {hash64(" ".join(terms[i : i + 3])) for i in range(max(0, len(terms) - 2))}
+    if not shingles:
+        return None
+    return [min((a * h + b) % MINHASH_PRIME for h in shingles) for a, b in MINHASH_PARAMS]
+
+
+@traced("collapse_near_duplicates")
+def collapse_near_duplicates(entries: List[Dict[str, Any]], field: str) -> tuple:
+    # Keeps the first (best ranked) of each duplicate group. Rows are compared by
+    # GitHub file identity, then SimHash of title+snippet (field="content") or
+    # MinHash of fetched text (field="context"). Returns (kept, collapsed).
+    kept: List[Dict[str, Any]] = []
+    collapsed: List[Dict[str, Any]] = []
+    variants: Dict[tuple, str] = {}
+    fingerprints: List[tuple] = []
+    for entry in entries:
+        url = str(entry.get("url") or "")
+        text = str(entry.get(field) or "")
+        variant = github_variant_key(url)
+        if variant is not None and variant in variants:
+            collapsed.append({"url": url, "duplicate_of": variants[variant], "method": "github_variant"})
+            continue
+        match: Optional[Dict[str, Any]] = None
+        if field == "content":
+            fp: Any = simhash(f"{entry.get('title') or ''} {text}")
+            if fp is not None:
+                for other_url, other in fingerprints:
+                    distance = (fp ^ other).bit_count()
+                    if distance <= SIMHASH_MAX_DISTANCE:
+                        match = {"duplicate_of": other_url, "method": "simhash", "distance": distance}
+                        break
+        else:
+            fp = minhash_signature(text) if text else None
+            if fp is not None:
+                for other_url, other in fingerprints:
+                    similarity = sum(1 for x, y in zip(fp, other) if x == y) / len(fp)
+                    if similarity >= MINHASH_THRESHOLD:
+                        match = {"duplicate_of": other_url, "method": "minhash", "similarity": round(similarity, 3)}
+                        break
+        if match is not None:
+            collapsed.append({"url": url, **match})
+            continue
+        if variant is not None:
+            variants[variant] = url
+        if fp is not None:
+            fingerprints.append((url, fp))
+        kept.append(entry)
+    return kept, collapsed
+
+
 def context_items_to_results(context_items: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
     out: List[Dict[str, Any]] = []
-    for c in context_items[: max(1, int(limit))]:
+    for c in [c for c in context_items if c.get("context")][: max(1, int(limit))]:
         url = str(c.get("url", ""))
         raw = str(c.get("context", ""))
         title = url.split("/")[-1] or "GitHub file context"
@@ -249,10 +1658,14 @@ def collect_queries(query: Optional[str], queries: List[str]) -> List[str]:
     return merged
 
 
-def compact_text(text: str, max_chars: int) -> str:
+def compact_text(text: str, max_chars: int, query: Optional[str] = None) -> str:
     t = re.sub(r"\s+", " ", (text or "")).strip()
     if len(t) <= max_chars:
         return t
+    if query:
+        selected = select_passages(t, max_chars, query)
+        if selected:
+            return selected
     clipped = t[:max_chars]
     parts = re.split(r"(?<=[.!?])\s+", clipped)
     if len(parts) <= 1:
@@ -267,121 +1680,1000 @@ def compact_text(text: str, max_chars: int) -> str:
     return " ".join(out).strip() or clipped
 
 
-async def fetch_clean_context(url: str, max_chars: int) -> str:
+def split_passages(text: str) -> List[str]:
+    # Greedy sentence packing into ~PASSAGE_CHARS chunks; one pass over the text.
+    passages: List[str] = []
+    current: List[str] = []
+    size = 0
+    for sentence in SENTENCE_END_RX.split(text):
+        # Overlong runs without sentence breaks are walked with an index so each
+        # chunk is sliced once; re-slicing the remainder would be quadratic.
+        start = 0
+        end = len(sentence)
+        while end - start > PASSAGE_CHARS * 2:
+            cut = sentence.rfind(" ", start, start + PASSAGE_CHARS)
+            if cut <= start:
+                cut = start + PASSAGE_CHARS
+            if current:
+                passages.append(" ".join(current))
+                current, size = [], 0
+            passages.append(sentence[start:cut].strip())
+            start = cut
+            while start < end and sentence[start].isspace():
+                start += 1
+        if start:
+            sentence = sentence[start:]
+        current.append(sentence)
+        size += len(sentence) + 1
+        if size >= PASSAGE_CHARS:
+            passages.append(" ".join(current))
+            current, size = [], 0
+    if current:
+        passages.append(" ".join(current))
+    return [p for p in passages if p]
+
+
+def select_passages(text: str, max_chars: int, query: str) -> str:
+    # Extractive selection: passages are scored by the query terms they contain
+    # (log-damped counts weighted by how rare each term is across passages), the
+    # best ones are packed until max_chars and emitted in document order with
+    # " ... " marking gaps. Passages without query terms are only taken as the
+    # direct neighbours of a scored pick. Term counting is a single pass over the text.
+    query_terms = set(rank_terms(query))
+    if not query_terms:
+        return ""
+    passages = split_passages(text)
+    scores = passage_scores(passages, query_terms)
+    if not any(scores):
+        return ""
+    n = len(passages)
+    picked: List[int] = []
+    anchors: set = set()
+    # Exact length of join_passages(passages, picked): characters of every piece
+    # (passages and "..." markers) plus one space between pieces.
+    chars = 0
+    pieces = 0
+    for i in sorted(range(n), key=lambda i: (-scores[i], i)):
+        if not scores[i] and i - 1 not in anchors and i + 1 not in anchors:
+            continue
+        pos = bisect.bisect_left(picked, i)
+        before = picked[pos - 1] if pos else -1
+        after = picked[pos] if pos < len(picked) else n
+        old_gap = 1 if picked and after != before + 1 else 0
+        gaps = (i != before + 1) + (after != i + 1) - old_gap
+        if chars + len(passages[i]) + 3 * gaps + pieces + gaps > max_chars:
+            continue
+        picked.insert(pos, i)
+        chars += len(passages[i]) + 3 * gaps
+        pieces += 1 + gaps
+        if scores[i]:
+            anchors.add(i)
+    if not picked:
+        best = max(range(n), key=lambda i: (scores[i], -i))
+        return compact_text(passages[best], max_chars)
+    return join_passages(passages, picked)
+
+
+def passage_scores(passages: List[str], query_terms: set) -> List[float]:
+    counts: List[Dict[str, int]] = []
+    df: Dict[str, int] = {}
+    for passage in passages:
+        tf: Dict[str, int] = {}
+        for term in rank_terms(passage):
+            if term in query_terms:
+                tf[term] = tf.get(term, 0) + 1
+        for term in tf:
+            df[term] = df.get(term, 0) + 1
+        counts.append(tf)
+    n = len(passages)
+    idf = {term: math.log(1.0 + n / d) for term, d in df.items()}
+    return [sum(idf[t] * (1.0 + math.log(f)) for t, f in tf.items()) for tf in counts]
+
+
+def join_passages(passages: List[str], picked: List[int]) -> str:
+    picked = sorted(picked)
+    out: List[str] = ["..."] if picked and picked[0] != 0 else []
+    for pos, i in enumerate(picked):
+        if pos and picked[pos - 1] != i - 1:
+            out.append("...")
+        out.append(passages[i])
+    if picked and picked[-1] != len(passages) - 1:
+        out.append("...")
+    return " ".join(out)
+
+
+def approx_tokens(text: str) -> int:
+    # Conservative estimate: one token per word piece of up to four characters and
+    # one per punctuation mark. That is roughly 3 characters per token on English
+    # prose, so it over-counts BPE tokenizers (~4) and budgets err on the short side.
+    return len(APPROX_TOKEN_RX.findall(text or ""))
+
+
+@traced("pack_context")
+def pack_context_items(items: List[Dict[str, Any]], budget_tokens: int, query: str = "") -> tuple:
+    # Global budget packer. Every item's context is split into passages; a
+    # passage's value is the item's rank prior times its query score, divided by
+    # how many passages of the same item rank above it (diminishing returns).
+    # Passages are taken greedily by value until the token budget is spent, each
+    # item paying a one-off header cost; a passage that does not fit is trimmed to
+    # the remaining budget when enough is left. Items that win no passage are
+    # dropped. Returns (items, stats).
+    query_terms = set(rank_terms(query))
+    candidates: List[tuple] = []
+    split: Dict[int, List[str]] = {}
+    for idx, item in enumerate(items):
+        context = str(item.get("context") or "")
+        if not context:
+            continue
+        passages = split_passages(context)
+        split[idx] = passages
+        scores = passage_scores(passages, query_terms) if query_terms else [0.0] * len(passages)
+        prior = 1.0 / (1.0 + 0.2 * idx)
+        preferred = sorted(range(len(passages)), key=lambda j: (-scores[j], j))
+        for k, j in enumerate(preferred):
+            value = prior * (1.0 + scores[j]) / (1.0 + k)
+            candidates.append((-value, idx, j, approx_tokens(passages[j])))
+    candidates.sort()
+    used = 0
+    picked: Dict[int, List[int]] = {}
+    trimmed = set()
+    for _neg, idx, j, tokens in candidates:
+        header = 0 if idx in picked else approx_tokens(str(items[idx].get("url") or "")) + 4
+        available = budget_tokens - used - header
+        if tokens > available:
+            if available < 32:
+                continue
+            passages = split[idx]
+            passages[j] = compact_text(passages[j], len(passages[j]) * available // tokens)
+            tokens = approx_tokens(passages[j])
+            trimmed.add(idx)
+            if not passages[j] or tokens > available:
+                continue
+        picked.setdefault(idx, []).append(j)
+        used += header + tokens
+    out: List[Dict[str, Any]] = []
+    dropped: List[str] = []
+    for idx, item in enumerate(items):
+        if idx not in split:
+            out.append(item)
+        elif idx in picked:
+            packed = join_passages(split[idx], picked[idx])
+            if idx in trimmed or len(picked[idx]) < len(split[idx]):
+                item = {**item, "context": packed, "packed": True}
+            out.append(item)
+        else:
+            dropped.append(str(item.get("url") or ""))
+    stats = {"budget_tokens": budget_tokens, "used_tokens": used, "items_kept": len(picked), "dropped": dropped}
+    return out, stats
+
+
+def context_budget(requested: Optional[int]) -> int:
+    # Explicit argument, then MCP_CONTEXT_BUDGET_TOKENS; 0 = do not pack.
+    if requested:
+        return int(requested)
+    return max(0, CONTEXT_BUDGET_TOKENS)
+
+
+def merged_context_text(items: List[Dict[str, Any]], max_chars: int = 0) -> str:
+    text = "\n\n".join([f"URL: {it.get('url','')}\n{it.get('context','')}" for it in items if it.get("context")]).strip()
+    return compact_text(text, max_chars) if max_chars > 0 else text
+
+
+async def fetch_clean_text(url: str) -> Dict[str, Any]:
     validate_http_url(url)
-    mirror = f"https://r.jina.ai/http://{url.replace('https://', '').replace('http://', '')}"
-    async with httpx.AsyncClient(timeout=25) as client:
-        res = await client.get(mirror)
-        if res.status_code != 200:
-            raise HTTPException(status_code=502, detail=f"context fetch failed: {res.status_code}")
-    return compact_text(res.text, max_chars)
+    mirror = f"{JINA_BASE}/http://{url.replace('https://', '').replace('http://', '')}"
+
+    async def fetch_mirror() -> Dict[str, Any]:
+        async with upstream_stream("jina", mirror) as res:
+            if res.status_code != 200:
+                raise HTTPException(status_code=502, detail=f"context fetch failed: {res.status_code}")
+            page = await read_capped_text(res)
+            return {**page, "links": markdown_links(url, page["text"])}
 
+    return await SINGLE_FLIGHTS["jina"].do(canonical_url(url), fetch_mirror)
 
-def strip_html_to_text(html: str) -> str:
-    text = re.sub(r"(?is)<script.*?>.*?</script>", " ", html or "")
-    text = re.sub(r"(?is)<style.*?>.*?</style>", " ", text)
-    text = re.sub(r"<[^>]+>", " ", text)
-    text = unescape(text)
-    return re.sub(r"\s+", " ", text).strip()
 
+def resolve_link(base_url: str, href: str) -> Optional[str]:
+    href = (href or "").strip()
+    if not href or href.lower().startswith(LINK_SKIP_PREFIXES):
+        return None
+    try:
+        p = urlparse(urljoin(base_url, href))
+    except ValueError:
+        return None
+    if p.scheme not in {"http", "https"} or not p.netloc:
+        return None
+    return p._replace(fragment="").geturl()
+
+
+def markdown_links(base_url: str, text: str) -> List[Dict[str, Any]]:
+    # Links in mirror output: markdown [anchor](href) pairs, falling back to bare URLs.
+    links: List[Dict[str, Any]] = []
+    for m in MARKDOWN_LINK_RX.finditer(text or ""):
+        u = resolve_link(base_url, m.group(2))
+        if u:
+            links.append({"url": u, "text": WHITESPACE_RX.sub(" ", m.group(1)).strip(), "position": m.start()})
+            if len(links) >= PAGE_LINKS_MAX:
+                return links
+    if links:
+        return links
+    for m in URL_RX.finditer(text or ""):
+        u = resolve_link(base_url, normalize_url(m.group(1)))
+        if u:
+            links.append({"url": u, "text": "", "position": m.start()})
+            if len(links) >= PAGE_LINKS_MAX:
+                break
+    return links
+
+
+# Incremental, single-pass HTML-to-text extraction: fed chunk by chunk, skips
+# non-content elements, decodes entities as it goes and reports when it has
+# collected max_chars of text so the caller can stop downloading. Anchors are
+# collected on the same pass, resolved against <base> or the page URL, with their
+# text, offset into the extracted text and whether they sit in page chrome.
+class HTMLTextExtractor(HTMLParser):
+    SKIP_TAGS = {"script", "style", "noscript", "svg", "template"}
+    CHROME_TAGS = {"nav", "header", "footer", "aside"}
+
+    def __init__(self, max_chars: int = 0, base_url: str = "") -> None:
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max(0, int(max_chars))
+        self.chars = 0
+        self.done = False
+        self.base_url = base_url
+        self.links: List[Dict[str, Any]] = []
+        self._parts: List[str] = []
+        self._skip_depth = 0
+        self._chrome_depth = 0
+        self._base_seen = False
+        self._anchor: Optional[Dict[str, Any]] = None
+        self._pending_space = False
+
+    def _base_tag(self, attrs: List[Any]) -> None:
+        href = dict(attrs).get("href")
+        if href and not self._base_seen:
+            self._base_seen = True
+            self.base_url = urljoin(self.base_url, href.strip())
+
+    def _close_anchor(self) -> None:
+        anchor, self._anchor = self._anchor, None
+        if anchor is None or len(self.links) >= PAGE_LINKS_MAX:
+            return
+        anchor["text"] = WHITESPACE_RX.sub(" ", "".join(anchor["text"])).strip()[:300]
+        self.links.append(anchor)
+
+    def handle_starttag(self, tag: str, attrs: List[Any]) -> None:
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in self.CHROME_TAGS:
+            self._chrome_depth += 1
+        elif tag == "base":
+            self._base_tag(attrs)
+        elif tag == "a":
+            self._close_anchor()
+            u = resolve_link(self.base_url, dict(attrs).get("href") or "")
+            if u:
+                self._anchor = {"url": u, "text": [], "position": self.chars}
+                if self._chrome_depth:
+                    self._anchor["chrome"] = True
+        self._pending_space = True
+
+    def handle_startendtag(self, tag: str, attrs: List[Any]) -> None:
+        if tag == "base":
+            self._base_tag(attrs)
+        self._pending_space = True
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in self.SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in self.CHROME_TAGS and self._chrome_depth:
+            self._chrome_depth -= 1
+        elif tag == "a":
+            self._close_anchor()
+        self._pending_space = True
+
+    def close(self) -> None:
+        super().close()
+        self._close_anchor()
+
+    def handle_data(self, data: str) -> None:
+        if self._skip_depth:
+            return
+        if self._anchor is not None:
+            self._anchor["text"].append(data)
+        if self.done:
+            return
+        chunk = WHITESPACE_RX.sub(" ", data)
+        if chunk.startswith(" "):
+            self._pending_space = True
+        stripped = chunk.strip()
+        if not stripped:
+            return
+        if self._pending_space and self._parts:
+            self._parts.append(" ")
+            self.chars += 1
+        self._parts.append(stripped)
+        self.chars += len(stripped)
+        self._pending_space = chunk.endswith(" ")
+        if self.max_chars and self.chars >= self.max_chars:
+            self.done = True
 
-async def fetch_direct_context(url: str, max_chars: int) -> str:
+    def text(self) -> str:
+        return "".join(self._parts)
+
+
+async def fetch_direct_text(url: str, max_chars: int = 0) -> Dict[str, Any]:
     validate_http_url(url)
-    headers = {
-        "User-Agent": "Mozilla/5.0 (compatible; appagent-mcp/1.3)",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-    }
-    async with httpx.AsyncClient(timeout=25, follow_redirects=True, headers=headers) as client:
-        res = await client.get(url)
+    # Stop reading once max_chars (plus slack for sentence trimming) has been extracted.
+    limit = max_chars + DIRECT_EXTRACT_SLACK_CHARS if max_chars > 0 else 0
+    async with upstream_stream("direct", url) as res:
         if res.status_code != 200:
             raise HTTPException(status_code=502, detail=f"direct fetch failed: {res.status_code}")
-    content_type = str(res.headers.get("content-type", "")).lower()
-    raw_text = res.text if "html" not in content_type else strip_html_to_text(res.text)
-    return compact_text(raw_text, max_chars)
+        reason = content_skip_reason(res.headers)
+        if reason:
+            raise FetchSkipped(reason)
+        content_type = str(res.headers.get("content-type", "")).lower()
+        decoder = codecs.getincrementaldecoder(res.encoding or "utf-8")(errors="replace")
+        state: Dict[str, Any] = {"truncated": None, "bytes": 0}
+        complete = True
+        links: List[Dict[str, Any]] = []
+        async with aclosing(iter_capped_body(res, state)) as body:
+            if "html" in content_type:
+                parser = HTMLTextExtractor(limit, base_url=str(res.url))
+                async for chunk in body:
+                    parser.feed(decoder.decode(chunk))
+                    if parser.done:
+                        complete = False
+                        break
+                else:
+                    parser.feed(decoder.decode(b"", final=True))
+                    parser.close()
+                text = parser.text()
+                links = parser.links
+            else:
+                parts: List[str] = []
+                size = 0
+                async for chunk in body:
+                    piece = decoder.decode(chunk)
+                    parts.append(piece)
+                    size += len(piece)
+                    if limit and size >= limit:
+                        complete = False
+                        break
+                else:
+                    parts.append(decoder.decode(b"", final=True))
+                text = "".join(parts)
+                links = markdown_links(str(res.url), text)
+    if state["truncated"]:
+        complete = False
+    return {"text": text, "complete": complete, "truncated": state["truncated"], "links": links}
+
 
+def page_cache_key(url: str) -> str:
+    return canonical_url(url)
 
-def extract_links_from_text(base_url: str, text: str, max_links: int, allow_external: bool) -> List[str]:
+
+async def race_page_sources(url: str, max_chars: int, timings: Dict[str, Any]) -> Dict[str, Any]:
+    # Hedged fetch: the mirror starts first and direct HTTP joins after HEDGE_DELAY
+    # (or at once when the mirror's p95 for this host is poor). The first usable
+    # result wins and the other attempt is cancelled.
+    host = (urlparse(url).netloc or "").lower()
+
+    async def attempt(source: str, coro: Any) -> Dict[str, Any]:
+        started = time.monotonic()
+        status = "error"
+        try:
+            page = await coro
+            status = "ok"
+            return {**page, "source": source}
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            timings[source] = {"ms": round(elapsed * 1000, 1), "status": status}
+            # A cancelled mirror attempt never finished, so its elapsed time would
+            # understate the latency; a lost race is recorded by the caller instead.
+            if source == "jina-mirror" and status != "cancelled":
+                MIRROR_LATENCY.record(host, elapsed if status == "ok" else float("inf"))
+
+    delay: Optional[float] = None
+    if HEDGE_ENABLED:
+        p95 = MIRROR_LATENCY.p95(host)
+        delay = 0.0 if p95 is not None and p95 >= HEDGE_P95_THRESHOLD else max(0.0, HEDGE_DELAY)
+    mirror = asyncio.ensure_future(attempt("jina-mirror", fetch_clean_text(url)))
+    started = [mirror]
+    pending = {mirror}
+    errors: Dict[str, BaseException] = {}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if mirror in done and mirror.exception() is None:
+            return mirror.result()
+        direct = asyncio.ensure_future(attempt("direct-http", fetch_direct_text(url, max_chars)))
+        started.append(direct)
+        pending.add(direct)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in started:
+                if task in done and task.exception() is None:
+                    if task is direct and not mirror.done():
+                        MIRROR_LATENCY.record(host, float("inf"))
+                    return task.result()
+            for task in done:
+                errors["jina-mirror" if task is mirror else "direct-http"] = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*started, return_exceptions=True)
+    direct_err = errors.get("direct-http")
+    if isinstance(direct_err, FetchSkipped):
+        raise direct_err
+    raise HTTPException(
+        status_code=502,
+        detail=f"url_context_failed: {errors.get('jina-mirror')}; fallback_failed: {direct_err}",
+    )
+
+
+async def fetch_page_text(url: str, max_chars: int = 0, fallback: bool = True) -> Dict[str, Any]:
+    async with observe_stage("page_text", url=url):
+        page = await request_memo(
+            ("page", page_cache_key(url), max_chars, fallback),
+            lambda: load_page_text(url, max_chars, fallback),
+        )
+    return dict(page)
+
+
+async def load_page_text(url: str, max_chars: int = 0, fallback: bool = True) -> Dict[str, Any]:
+    # The cache holds the full extracted text so any max_chars can be served from it.
+    # Early-terminated direct extractions are only reused when they are long enough.
+    reason = binary_url_reason(url)
+    if reason:
+        raise FetchSkipped(reason)
+    key = page_cache_key(url)
+    cached = PAGE_CACHE.get(key)
+    if cached is not None and (cached["complete"] or (max_chars > 0 and len(cached["text"]) >= max_chars)):
+        span_note(cache="hit", source=cached["source"], chars=len(cached["text"]))
+        return {
+            "text": cached["text"],
+            "source": cached["source"],
+            "truncated": cached["truncated"],
+            "links": cached.get("links") or [],
+        }
+    timings: Dict[str, Any] = {}
+    if fallback:
+        page = await race_page_sources(url, max_chars, timings)
+    else:
+        page = {**await fetch_clean_text(url), "source": "jina-mirror"}
+    source = page["source"]
+    complete = page.get("complete", not page["truncated"])
+    links = page.get("links") or []
+    # Request-budget truncation depends on the caller, so such pages are not cached.
+    if page["truncated"] != "request_byte_budget":
+        PAGE_CACHE.set(key, page["text"], source=source, complete=complete, truncated=page["truncated"], links=links)
+    span_note(cache="miss", source=source, chars=len(page["text"]))
+    out = {"text": page["text"], "source": source, "truncated": page["truncated"], "links": links}
+    if timings:
+        out["source_timings"] = timings
+    return out
+
+
+def link_terms(text: str) -> List[str]:
+    return [t for t in LINK_TOKEN_RX.findall((text or "").lower()) if t not in LINK_STOPWORDS]
+
+
+def page_term_weights(text: str, top: int = 40) -> Dict[str, float]:
+    counts: Dict[str, int] = {}
+    for term in link_terms((text or "")[:20000]):
+        counts[term] = counts.get(term, 0) + 1
+    ranked = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))[:top]
+    if not ranked:
+        return {}
+    peak = float(ranked[0][1])
+    return {term: n / peak for term, n in ranked}
+
+
+def rank_links(
+    base_url: str,
+    links: List[Dict[str, Any]],
+    page_text: str,
+    query: str,
+    max_links: int,
+    allow_external: bool,
+) -> List[Dict[str, Any]]:
+    # Scores anchors before anything is fetched: anchor text and URL path terms that
+    # match the query or the page's own dominant terms score up, links in page
+    # chrome (nav/header/footer/aside) or with account/legal/social wording score
+    # down, children of the current path get a bonus and earlier links win ties.
     base = urlparse(base_url)
-    base_host = (base.netloc or "").lower()
-    base_path = (base.path or "").rstrip("/")
-    base_query = base.query or ""
-    base_key = f"{base_host}|{base_path}|{base_query}"
-    out: List[str] = []
-    seen = set()
-    for raw in URL_RX.findall(text or ""):
-        u = normalize_url(raw)
-        if not u.lower().startswith("http"):
-            continue
+    base_host = canonical_host(base.hostname or "")
+    base_dir = (base.path or "/").rsplit("/", 1)[0] + "/"
+    self_key = page_cache_key(base_url)
+    query_terms = set(link_terms(query))
+    page_terms = page_term_weights(page_text)
+    text_len = max(1, len(page_text or ""))
+    best: Dict[str, Dict[str, Any]] = {}
+    for order, link in enumerate(links or []):
         try:
-            p = urlparse(u)
-        except Exception:
-            continue
-        if p.fragment:
-            p = p._replace(fragment="")
-            u = p.geturl()
-        host = (p.netloc or "").lower()
-        if not allow_external and base_host and host and host != base_host:
+            p = urlparse(link["url"])
+        except ValueError:
             continue
-        cand_path = (p.path or "").rstrip("/")
-        cand_key = f"{host}|{cand_path}|{p.query or ''}"
-        if cand_key == base_key:
+        host = canonical_host(p.hostname or "")
+        if not allow_external and base_host and host != base_host:
             continue
-        key = cand_key.lower()
-        if key in seen:
+        key = page_cache_key(link["url"])
+        if key == self_key or binary_url_reason(link["url"]):
             continue
-        seen.add(key)
-        out.append(u)
-        if len(out) >= max_links:
-            break
+        anchor = link.get("text") or ""
+        terms = set(link_terms(anchor + " " + re.sub(r"[-_./]+", " ", p.path or "")))
+        score = 0.0
+        if query_terms:
+            score += 3.0 * len(terms & query_terms) / len(query_terms)
+        if terms:
+            score += sum(page_terms.get(t, 0.0) for t in terms) / len(terms)
+        if host == base_host and (p.path or "/").startswith(base_dir):
+            score += 0.5
+        if link.get("chrome"):
+            score -= 1.0
+        if LINK_NOISE_RX.search(anchor) or LINK_NOISE_RX.search(p.path or ""):
+            score -= 1.5
+        score -= 0.3 * min(1.0, float(link.get("position", 0)) / text_len)
+        prev = best.get(key)
+        if prev is None or score > prev["score"]:
+            best[key] = {"url": link["url"], "text": anchor, "score": round(score, 4), "order": order}
+    ranked = sorted(best.values(), key=lambda row: (-row["score"], row["order"]))
+    return [{"url": r["url"], "text": r["text"], "score": r["score"]} for r in ranked[: max(0, max_links)]]
+
+
+def page_context_item(url: str, page: Dict[str, Any], max_chars: int, query: str = "") -> Dict[str, Any]:
+    item = {"url": url, "context": compact_text(page["text"], max_chars, query), "source": page["source"]}
+    if page.get("truncated"):
+        item["truncated"] = page["truncated"]
+    if page.get("source_timings"):
+        item["source_timings"] = page["source_timings"]
+    return item
+
+
+async def fetch_context_with_fallback(url: str, max_chars: int, query: str = "") -> Dict[str, Any]:
+    try:
+        # Query-aware selection needs the whole page, not an early-terminated prefix.
+        page = await fetch_page_text(url, 0 if query else max_chars)
+    except FetchSkipped as skip:
+        return {"url": url, "context": "", "source": "none", "skipped": skip.reason}
+    except HTTPException as err:
+        return {"url": url, "context": "", "source": "none", "error": str(err.detail)}
+    except Exception as err:
+        return {"url": url, "context": "", "source": "none", "error": str(err)}
+    return page_context_item(url, page, max_chars, query)
+
+
+async def parse_sitemap(url: str, state: Dict[str, Any]) -> Dict[str, List[str]]:
+    # Streams one sitemap (plain or gzip) through XMLPullParser. state["bytes"] is
+    # the decompressed byte allowance shared by every file of one host's discovery.
+    out: Dict[str, List[str]] = {"urls": [], "sitemaps": []}
+    async with upstream_stream("direct", url) as res:
+        if res.status_code != 200:
+            return out
+        parser = ET.XMLPullParser(events=("end",))
+        inflater: Any = None
+        started = False
+        async for chunk in res.aiter_bytes():
+            if state["bytes"] <= 0:
+                state["truncated"] = True
+                break
+            if inflater is None:
+                inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) if chunk[:2] == b"\x1f\x8b" else False
+            data = inflater.decompress(chunk, max(0, state["bytes"])) if inflater else chunk
+            if not started:
+                # Entity declarations are never needed in a sitemap; refuse them outright.
+                if b"<!DOCTYPE" in data[:2048].upper() or b"<!ENTITY" in data[:2048].upper():
+                    return out
+                started = True
+            data = data[: max(0, state["bytes"])]
+            state["bytes"] -= len(data)
+            try:
+                parser.feed(data)
+                for _, elem in parser.read_events():
+                    tag = elem.tag.rsplit("}", 1)[-1]
+                    if tag in {"url", "sitemap"}:
+                        loc = next((c.text for c in elem if c.tag.rsplit("}", 1)[-1] == "loc"), None)
+                        if loc and loc.strip():
+                            out["urls" if tag == "url" else "sitemaps"].append(loc.strip())
+                        elem.clear()
+            except ET.ParseError:
+                return out
+            if state["bytes"] <= 0 or len(out["urls"]) >= SITEMAP_MAX_URLS:
+                state["truncated"] = True
+                break
     return out
 
 
-async def fetch_context_with_fallback(url: str, max_chars: int) -> Dict[str, Any]:
-    try:
-        return {"url": url, "context": await fetch_clean_context(url, max_chars), "source": "jina-mirror"}
-    except Exception:
+async def discover_sitemap_urls(page_url: str) -> Dict[str, Any]:
+    # Sitemap URLs come from robots.txt "Sitemap:" lines, defaulting to /sitemap.xml.
+    # Index files are expanded one level. The result is cached per origin.
+    p = urlparse(page_url)
+    origin = f"{p.scheme}://{p.netloc}".lower()
+    cached = SITEMAP_CACHE.get(origin)
+    if cached is not None:
+        return {**cached, "cached": True}
+
+    async def discover() -> Dict[str, Any]:
+        sitemaps: List[str] = []
         try:
-            return {"url": url, "context": await fetch_direct_context(url, max_chars), "source": "direct-http"}
-        except Exception as err:
-            return {"url": url, "context": "", "source": "none", "error": str(err)}
+            async with upstream_stream("direct", f"{origin}/robots.txt") as res:
+                if res.status_code == 200:
+                    robots = await read_capped_text(res)
+                    for line in robots["text"].splitlines():
+                        name, _, value = line.partition(":")
+                        if name.strip().lower() == "sitemap" and value.strip().lower().startswith("http"):
+                            sitemaps.append(value.strip())
+        except (FetchSkipped, HTTPException, httpx.HTTPError):
+            pass
+        if not sitemaps:
+            sitemaps = [f"{origin}/sitemap.xml"]
+        state: Dict[str, Any] = {"bytes": SITEMAP_MAX_BYTES, "truncated": False}
+        urls: List[str] = []
+        queue = unique_urls(sitemaps)[: max(1, SITEMAP_MAX_FILES)]
+        files = 0
+        for level in range(2):
+            if not queue:
+                break
+            files += len(queue)
+            parsed = await gather_bounded([parse_sitemap(u, state) for u in queue], 4)
+            queue = []
+            for row in parsed:
+                if isinstance(row, BaseException):
+                    continue
+                urls.extend(row["urls"])
+                if level == 0:
+                    queue.extend(row["sitemaps"])
+            queue = unique_urls(queue)[: max(0, SITEMAP_MAX_FILES - files)]
+        result = {"urls": unique_urls(urls)[: max(0, SITEMAP_MAX_URLS)], "files": files, "truncated": state["truncated"]}
+        SITEMAP_CACHE.set(origin, result)
+        return result
+
+    result = await SINGLE_FLIGHTS["sitemap"].do(origin, discover)
+    return {**result, "cached": False}
+
+
+def sitemap_candidates(page_url: str, urls: List[str], query: str, max_links: int) -> List[Dict[str, Any]]:
+    # Keeps same-host URLs under the requested URL's directory, shallowest paths
+    # first, then lets rank_links order them by query/path terms.
+    p = urlparse(page_url)
+    host = canonical_host(p.hostname or "")
+    prefix = (p.path or "/") if (p.path or "/").endswith("/") else (p.path or "/").rsplit("/", 1)[0] + "/"
+    rows = []
+    for order, u in enumerate(urls):
+        c = urlparse(u)
+        if canonical_host(c.hostname or "") != host or not (c.path or "/").startswith(prefix):
+            continue
+        rows.append(((c.path or "/").count("/"), order, u))
+    rows.sort()
+    links = [{"url": u, "text": "", "position": 0} for _, _, u in rows]
+    return rank_links(page_url, links, "", query, max_links, False)
 
 
-async def fetch_context_items(urls: List[str], max_urls: int, max_chars: int) -> List[Dict[str, Any]]:
+# Discoveries the crawl stopped waiting for; they keep running so the result is
+# cached for the next crawl of the same origin instead of timing out every time.
+SITEMAP_BACKGROUND: set = set()
+
+
+@traced("sitemap_discovery")
+async def sitemap_discovery(page_url: str, query: str, max_links: int) -> Dict[str, Any]:
+    started = time.monotonic()
+    task = asyncio.ensure_future(discover_sitemap_urls(page_url))
+    SITEMAP_BACKGROUND.add(task)
+    task.add_done_callback(lambda t: SITEMAP_BACKGROUND.discard(t) or t.cancelled() or t.exception())
+    found = await asyncio.wait_for(asyncio.shield(task), timeout=max(0.1, SITEMAP_DISCOVERY_TIMEOUT))
+    links = [{**link, "discovered": "sitemap"} for link in sitemap_candidates(page_url, found["urls"], query, max_links)]
+    return {
+        "links": links,
+        "stats": {
+            "files": found["files"],
+            "urls": len(found["urls"]),
+            "candidates": len(links),
+            "truncated": found["truncated"],
+            "cached": found["cached"],
+            "ms": round((time.monotonic() - started) * 1000, 1),
+        },
+    }
+
+
+@traced("crawl")
+async def crawl_site(
+    seed: str,
+    max_urls: int,
+    max_chars: int,
+    max_depth: int,
+    max_pages: int,
+    time_budget: float,
+    allow_external: bool,
+    query: str = "",
+    discovery: Any = None,
+) -> Dict[str, Any]:
+    # Bounded best-first crawl: the frontier is ordered by depth, then link score
+    # (see rank_links), then discovery order. The visited set uses canonical URL
+    # keys, and the crawl stops as soon as max_urls pages with context are
+    # collected or the page/time budget runs out. An optional discovery awaitable
+    # (sitemap candidates) runs alongside the seed fetch and its links join the
+    # frontier at depth 1 when it finishes. The max_urls stop waits for the seed,
+    # so the requested page is never cancelled by faster sitemap pages.
+    started = time.monotonic()
+    deadline = started + max(0.1, time_budget)
+    frontier: List[tuple] = [(0, 0.0, 0, seed, None)]
+    seen = {page_cache_key(seed)}
+    seq = 1
+    host_limits: Dict[str, asyncio.Semaphore] = {}
+    in_flight: Dict["asyncio.Task[Any]", tuple] = {}
+    fetched: List[tuple] = []
+    good = 0
+    pages = 0
+    depth_reached = 0
+    stopped = "frontier_exhausted"
+    seed_done = False
+    discovered: Optional[Dict[str, Any]] = None
+    pending_discovery = asyncio.ensure_future(discovery) if discovery is not None else None
+
+    def push_links(links: List[Dict[str, Any]], depth: int) -> None:
+        nonlocal seq
+        for link in links:
+            key = page_cache_key(link["url"])
+            if key in seen:
+                continue
+            seen.add(key)
+            heapq.heappush(frontier, (depth, -link["score"], seq, link["url"], link))
+            seq += 1
+
+    async def visit(url: str, depth: int) -> tuple:
+        host = (urlparse(url).netloc or "").lower()
+        limit = host_limits.setdefault(host, asyncio.Semaphore(max(1, CRAWL_HOST_CONCURRENCY)))
+        async with limit:
+            try:
+                # Pages whose links will be followed are read in full so no anchors are cut off.
+                page = await fetch_page_text(url, max_chars if depth >= max_depth and not query else 0)
+            except FetchSkipped as skip:
+                return {"url": url, "context": "", "source": "none", "skipped": skip.reason}, None
+            except HTTPException as err:
+                return {"url": url, "context": "", "source": "none", "error": str(err.detail)}, None
+            except Exception as err:
+                return {"url": url, "context": "", "source": "none", "error": str(err)}, None
+        return page_context_item(url, page, max_chars, query), page
+
+    try:
+        while True:
+            # Only keep enough pages in flight to fill the remaining quota, plus a
+            # little slack for pages that turn out empty or fail.
+            width = min(max(1, CRAWL_CONCURRENCY), max_urls - good + max(0, CRAWL_SPECULATIVE_PAGES))
+            while frontier and good < max_urls and len(in_flight) < width and pages < max_pages:
+                depth, _score, _seq, url, via = heapq.heappop(frontier)
+                in_flight[asyncio.ensure_future(visit(url, depth))] = (pages, url, depth, via)
+                pages += 1
+            if good >= max_urls and seed_done:
+                stopped = "max_urls"
+                break
+            if not in_flight and pending_discovery is None:
+                if frontier and pages >= max_pages:
+                    stopped = "page_budget"
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                stopped = "time_budget"
+                break
+            waiting = set(in_flight) | ({pending_discovery} if pending_discovery is not None else set())
+            done, _ = await asyncio.wait(waiting, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if pending_discovery is not None and pending_discovery in done:
+                done.discard(pending_discovery)
+                try:
+                    discovered = pending_discovery.result()
+                except Exception as err:
+                    discovered = {"links": [], "stats": {"error": str(err) or type(err).__name__}}
+                pending_discovery = None
+                push_links(discovered["links"], 1)
+            for task in done:
+                order, url, depth, via = in_flight.pop(task)
+                item, page = task.result()
+                seed_done = seed_done or order == 0
+                if via:
+                    item = {**item, "depth": depth, "link_score": via["score"]}
+                    if via.get("discovered"):
+                        item["discovered"] = via["discovered"]
+                    else:
+                        item["anchor_text"] = via["text"]
+                fetched.append((order, url, item))
+                depth_reached = max(depth_reached, depth)
+                if not item.get("context"):
+                    continue
+                good += 1
+                if depth >= max_depth or good >= max_urls:
+                    continue
+                ranked = rank_links(url, page.get("links") or [], page["text"], query, CRAWL_LINKS_PER_PAGE, allow_external)
+                push_links(ranked, depth + 1)
+    finally:
+        for task in in_flight:
+            task.cancel()
+        if pending_discovery is not None:
+            pending_discovery.cancel()
+        leftovers = list(in_flight) + ([pending_discovery] if pending_discovery is not None else [])
+        if leftovers:
+            await asyncio.gather(*leftovers, return_exceptions=True)
+    if stopped == "time_budget":
+        for order, url, _depth, _via in in_flight.values():
+            fetched.append((order, url, {"url": url, "context": "", "source": "none", "skipped": "crawl_time_budget"}))
+
+    fetched.sort(key=lambda row: row[0])
+    items = [item for _, _, item in fetched]
+    good_items = [it for it in items if it.get("context")]
+    if len(good_items) > max_urls:
+        keep = {id(it) for it in good_items[:max_urls]}
+        items = [it for it in items if not it.get("context") or id(it) in keep]
+    return {
+        "items": items,
+        "visited": [url for _, url, _ in fetched],
+        "stats": {
+            "stopped": stopped,
+            "pages_fetched": len(fetched),
+            "pages_with_context": min(good, max_urls),
+            "depth_reached": depth_reached,
+            "frontier_remaining": len(frontier),
+            "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+            **({"sitemap": discovered["stats"]} if discovered else {}),
+        },
+    }
+
+
+async def fetch_context_items(
+    urls: List[str],
+    max_urls: int,
+    max_chars: int,
+    limiter: Optional[asyncio.Semaphore] = None,
+    query: str = "",
+) -> List[Dict[str, Any]]:
     picked = unique_urls(urls)[: max(0, max_urls)]
     if not picked:
         return []
-    tasks = [fetch_clean_context(u, max_chars) for u in picked]
+    tasks = [run_limited(limiter, fetch_page_text(u, 0 if query else max_chars, fallback=False)) for u in picked]
     results = await asyncio.gather(*tasks, return_exceptions=True)
     out: List[Dict[str, Any]] = []
-    for u, c in zip(picked, results):
-        if isinstance(c, Exception):
+    for u, page in zip(picked, results):
+        if isinstance(page, FetchSkipped):
+            out.append({"url": u, "context": "", "source": "none", "skipped": page.reason})
+            continue
+        if isinstance(page, Exception):
             continue
-        out.append({"url": u, "context": c})
+        out.append(page_context_item(u, page, max_chars, query))
     return out
 
 
+@traced("github_api")
+async def github_api_json(key: tuple, url: str, params: Optional[Dict[str, str]] = None) -> Any:
+    cached = GITHUB_META_CACHE.get(key)
+    now = time.monotonic()
+    if cached is not None and now - cached["checked_at"] < GITHUB_REVALIDATE_AFTER:
+        note_github_cache("fresh")
+        return cached["data"]
+    headers = {"If-None-Match": cached["etag"]} if cached is not None and cached["etag"] else {}
+    try:
+        res = await upstream_get("github_api", url, params=params, headers=headers)
+    except (HTTPException, httpx.HTTPError):
+        # Circuit open or upstream down: serve the last known copy rather than nothing.
+        if cached is None:
+            raise
+        note_github_cache("stale")
+        return cached["data"]
+    if res.status_code == 304 and cached is not None:
+        # 304s are cheap and do not count against the authenticated rate limit.
+        note_github_cache("revalidated")
+        GITHUB_META_CACHE.set(key, {**cached, "checked_at": now})
+        return cached["data"]
+    if res.status_code != 200:
+        # Rate limits arrive as 403 as well as 429, so any failure falls back to the cache.
+        if cached is None:
+            return None
+        note_github_cache("stale")
+        return cached["data"]
+    note_github_cache("fetched")
+    data = res.json()
+    GITHUB_META_CACHE.set(key, {"etag": res.headers.get("etag", ""), "data": data, "checked_at": now})
+    return data
+
+
+async def fetch_github_tree(owner: str, repo: str) -> Optional[Dict[str, Any]]:
+    repo_key = (owner.lower(), repo.lower())
+
+    async def fetch_tree() -> Optional[Dict[str, Any]]:
+        repo_info = await github_api_json(("repo",) + repo_key, f"{GITHUB_API_BASE}/repos/{owner}/{repo}")
+        if not isinstance(repo_info, dict):
+            return None
+        branch = repo_info.get("default_branch") or "main"
+        tree_data = await github_api_json(
+            ("tree",) + repo_key + (branch,),
+            f"{GITHUB_API_BASE}/repos/{owner}/{repo}/git/trees/{branch}",
+            params={"recursive": "1"},
+        )
+        if not isinstance(tree_data, dict):
+            return None
+        return {"branch": branch, "tree": tree_data.get("tree", []) or []}
+
+    return await SINGLE_FLIGHTS["github_repo"].do(repo_key, fetch_tree)
+
+
+@traced("github_raw")
+async def fetch_github_raw_text(
+    owner: str, repo: str, ref: str, path: str, sha: str = ""
+) -> Optional[Dict[str, Any]]:
+    # Returns {"text", "truncated"}, or None when the file is missing or not text.
+    if binary_url_reason(path):
+        return None
+    if sha:
+        by_sha = GITHUB_BLOB_CACHE.get(("sha", sha))
+        if by_sha is not None:
+            note_github_cache("blob_sha_hits")
+            return {"text": by_sha["text"], "truncated": by_sha["truncated"]}
+    raw_url = f"{GITHUB_RAW_BASE}/{owner}/{repo}/{ref}/{path}"
+
+    async def fetch_raw() -> Optional[Dict[str, Any]]:
+        # Without a blob SHA the ref may move, so revalidate the raw URL by ETag instead.
+        cached = None if sha else GITHUB_BLOB_CACHE.get(("raw", raw_url))
+        now = time.monotonic()
+        if cached is not None and now - cached["checked_at"] < GITHUB_REVALIDATE_AFTER:
+            note_github_cache("fresh")
+            return {"text": cached["text"], "truncated": cached["truncated"]}
+        headers = {"If-None-Match": cached["etag"]} if cached is not None and cached["etag"] else {}
+        try:
+            async with upstream_stream("github_raw", raw_url, headers=headers) as res:
+                if res.status_code == 304 and cached is not None:
+                    note_github_cache("revalidated")
+                    GITHUB_BLOB_CACHE.touch(("raw", raw_url), checked_at=now)
+                    return {"text": cached["text"], "truncated": cached["truncated"]}
+                if res.status_code != 200:
+                    if cached is None:
+                        return None
+                    note_github_cache("stale")
+                    return {"text": cached["text"], "truncated": cached["truncated"]}
+                try:
+                    body = await read_capped_text(res)
+                except FetchSkipped:
+                    return None
+                etag = res.headers.get("etag", "")
+        except (HTTPException, httpx.HTTPError):
+            if cached is None:
+                raise
+            note_github_cache("stale")
+            return {"text": cached["text"], "truncated": cached["truncated"]}
+        note_github_cache("fetched")
+        if body["truncated"] != "request_byte_budget":
+            if sha:
+                GITHUB_BLOB_CACHE.set(("sha", sha), body["text"], truncated=body["truncated"])
+            else:
+                GITHUB_BLOB_CACHE.set(
+                    ("raw", raw_url), body["text"], truncated=body["truncated"], etag=etag, checked_at=now
+                )
+        return {"text": body["text"], "truncated": body["truncated"]}
+
+    return await SINGLE_FLIGHTS["github_raw"].do(raw_url, fetch_raw)
+
+
+@traced("github_repo_context")
 async def fetch_github_repo_context(
     owner: str,
     repo: str,
     max_files: int,
     max_chars_per_file: int,
     path_prefix: str = "",
+    limiter: Optional[asyncio.Semaphore] = None,
+    query: str = "",
 ) -> List[Dict[str, Any]]:
     max_files = max(1, min(20, int(max_files)))
     max_chars_per_file = max(500, min(5000, int(max_chars_per_file)))
-    async with httpx.AsyncClient(timeout=20, headers={"User-Agent": "appagent-mcp/1.1"}) as client:
-        repo_res = await client.get(f"https://api.github.com/repos/{owner}/{repo}")
-        if repo_res.status_code != 200:
-            return []
-        repo_info = repo_res.json()
-        branch = repo_info.get("default_branch") or "main"
-        tree_res = await client.get(f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}", params={"recursive": "1"})
-        if tree_res.status_code != 200:
-            return []
-        tree = tree_res.json().get("tree", []) or []
+    async with observe_stage("github_tree"):
+        repo_tree = await run_limited(limiter, fetch_github_tree(owner, repo))
+    if not repo_tree:
+        return []
+    branch = repo_tree["branch"]
+    tree = repo_tree["tree"]
 
     preferred: List[str] = []
     others: List[str] = []
+    blob_shas: Dict[str, str] = {}
     normalized_prefix = str(path_prefix or "").strip("/").lower()
     for node in tree:
         if node.get("type") != "blob":
@@ -392,6 +2684,7 @@ async def fetch_github_repo_context(
         lower = path.lower()
         if normalized_prefix and not lower.startswith(normalized_prefix):
             continue
+        blob_shas[path] = str(node.get("sha") or "")
         if re.search(r"(readme|dockerfile|compose|package\.json|requirements\.txt|pyproject\.toml|setup\.py|go\.mod|cargo\.toml|pom\.xml|build\.gradle)", lower):
             preferred.append(path)
         elif re.search(r"\.(md|txt|py|js|ts|tsx|jsx|json|yml|yaml|toml)$", lower):
@@ -401,27 +2694,33 @@ async def fetch_github_repo_context(
         return []
 
     contexts: List[Dict[str, Any]] = []
-    async with httpx.AsyncClient(timeout=25, headers={"User-Agent": "appagent-mcp/1.1"}) as client:
-        tasks = [client.get(f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}") for path in selected]
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
+    tasks = [
+        run_limited(limiter, fetch_github_raw_text(owner, repo, branch, path, sha=blob_shas.get(path, "")))
+        for path in selected
+    ]
+    responses = await asyncio.gather(*tasks, return_exceptions=True)
     for path, res in zip(selected, responses):
-        if isinstance(res, Exception):
-            continue
-        if getattr(res, "status_code", 0) != 200:
+        if isinstance(res, Exception) or res is None:
             continue
-        snippet = compact_text(getattr(res, "text", ""), max_chars_per_file)
+        snippet = compact_text(res["text"], max_chars_per_file, query)
         if not snippet:
             continue
-        contexts.append(
-            {
-                "url": f"https://github.com/{owner}/{repo}/blob/{branch}/{path}",
-                "context": f"[GitHub file: {path}] {snippet}",
-            }
-        )
+        entry = {
+            "url": f"https://github.com/{owner}/{repo}/blob/{branch}/{path}",
+            "context": f"[GitHub file: {path}] {snippet}",
+        }
+        if res["truncated"]:
+            entry["truncated"] = res["truncated"]
+        contexts.append(entry)
     return contexts
 
 
-async def fetch_github_target_context(url: str, max_urls: int, max_chars_per_url: int) -> List[Dict[str, Any]]:
+async def fetch_github_target_context(
+    url: str,
+    max_urls: int,
+    max_chars_per_url: int,
+    query: str = "",
+) -> List[Dict[str, Any]]:
     target = parse_github_target(url)
     if not target:
         return []
@@ -434,24 +2733,25 @@ async def fetch_github_target_context(url: str, max_urls: int, max_chars_per_url
     items: List[Dict[str, Any]] = []
     seen = set()
 
-    async def add_item(item_url: str, text: str, source: str) -> None:
-        key = (item_url or "").strip().lower()
+    async def add_item(item_url: str, text: str, source: str, truncated: Optional[str] = None) -> None:
+        key = canonical_url(item_url) if item_url else ""
         if not key or key in seen:
             return
         seen.add(key)
-        compact = compact_text(text, max_chars_per_url)
+        compact = compact_text(text, max_chars_per_url, query)
         if not compact:
             return
-        items.append({"url": item_url, "context": compact, "source": source})
+        item = {"url": item_url, "context": compact, "source": source}
+        if truncated:
+            item["truncated"] = truncated
+        items.append(item)
 
     if kind == "blob" and rel_path:
-        raw_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{ref}/{rel_path}"
         blob_url = f"https://github.com/{owner}/{repo}/blob/{ref}/{rel_path}"
         try:
-            async with httpx.AsyncClient(timeout=25, headers={"User-Agent": "appagent-mcp/1.1"}) as client:
-                res = await client.get(raw_url)
-            if res.status_code == 200:
-                await add_item(blob_url, f"[GitHub file: {rel_path}] {res.text}", "github-raw")
+            raw = await fetch_github_raw_text(owner, repo, ref, rel_path)
+            if raw is not None:
+                await add_item(blob_url, f"[GitHub file: {rel_path}] {raw['text']}", "github-raw", raw["truncated"])
         except Exception:
             pass
 
@@ -460,21 +2760,61 @@ async def fetch_github_target_context(url: str, max_urls: int, max_chars_per_url
         repo_prefix = rel_path.rsplit("/", 1)[0]
     else:
         repo_prefix = ""
-    repo_items = await fetch_github_repo_context(
-        owner,
-        repo,
-        max_files=repo_budget,
-        max_chars_per_file=max_chars_per_url,
-        path_prefix=repo_prefix,
-    )
+    try:
+        repo_items = await fetch_github_repo_context(
+            owner,
+            repo,
+            max_files=repo_budget,
+            max_chars_per_file=max_chars_per_url,
+            path_prefix=repo_prefix,
+            query=query,
+        )
+    except (HTTPException, httpx.HTTPError):
+        repo_items = []
     for entry in repo_items:
-        await add_item(str(entry.get("url", "")), str(entry.get("context", "")), "github-repo")
+        await add_item(str(entry.get("url", "")), str(entry.get("context", "")), "github-repo", entry.get("truncated"))
         if len(items) >= max_urls:
             break
 
     return items[:max_urls]
 
 
+async def gather_context_with_repos(
+    urls: List[str],
+    max_urls: int,
+    max_chars: int,
+    repo_scopes: List[Dict[str, str]],
+    repo_max_files: int,
+    repo_max_chars: int,
+    query: str = "",
+) -> List[Dict[str, Any]]:
+    # URL contexts and every repo scope run as one task group under a shared limit;
+    # results keep the sequential layout: URL items first, then each scope in order.
+    limiter = asyncio.Semaphore(max(1, CONTEXT_FETCH_CONCURRENCY))
+    async with observe_stage("context_gather"):
+        groups = await asyncio.gather(
+            fetch_context_items(urls, max_urls, max_chars, limiter=limiter, query=query),
+            *[
+                fetch_github_repo_context(
+                    scope["owner"],
+                    scope["repo"],
+                    max_files=repo_max_files,
+                    max_chars_per_file=repo_max_chars,
+                    limiter=limiter,
+                    query=query,
+                )
+                for scope in repo_scopes
+            ],
+            return_exceptions=True,
+        )
+    out: List[Dict[str, Any]] = []
+    for group in groups:
+        if isinstance(group, Exception):
+            continue
+        out.extend(group)
+    return out
+
+
 def mcp_tools_payload() -> List[Dict[str, Any]]:
     return [
         {
@@ -497,6 +2837,9 @@ def mcp_tools_payload() -> List[Dict[str, Any]]:
                     "context_max_urls": {"type": "number", "default": 2},
                     "context_max_chars": {"type": "number", "default": 1400},
                     "strict_repo_only": {"type": "boolean", "default": False},
+                    "no_cache": {"type": "boolean", "default": False},
+                    "budget_tokens": {"type": "number"},
+                    "debug_timings": {"type": "boolean", "default": False},
                 },
                 "anyOf": [{"required": ["query"]}, {"required": ["queries"]}],
             },
@@ -526,6 +2869,10 @@ def mcp_tools_payload() -> List[Dict[str, Any]]:
                     "context_max_urls": {"type": "number", "default": 5},
                     "context_max_chars": {"type": "number", "default": 1800},
                     "strict_repo_only": {"type": "boolean", "default": True},
+                    "no_cache": {"type": "boolean", "default": False},
+                    "rrf_k": {"type": "number", "default": 60},
+                    "budget_tokens": {"type": "number"},
+                    "debug_timings": {"type": "boolean", "default": False},
                 },
                 "anyOf": [{"required": ["query"]}, {"required": ["queries"]}],
             },
@@ -544,6 +2891,9 @@ def mcp_tools_payload() -> List[Dict[str, Any]]:
                     "url": {"type": "string"},
                     "max_urls": {"type": "number", "default": 5},
                     "max_chars_per_url": {"type": "number", "default": 2200},
+                    "query": {"type": "string"},
+                    "budget_tokens": {"type": "number"},
+                    "debug_timings": {"type": "boolean", "default": False},
                 },
                 "required": ["url"],
             },
@@ -552,7 +2902,7 @@ def mcp_tools_payload() -> List[Dict[str, Any]]:
             "name": "fetch_url_context_smart",
             "description": (
                 "Use when the user asks to inspect a URL deeply across multiple related links. "
-                "Starts from the given URL, follows additional links (same host by default), "
+                "Starts from the given URL, crawls linked pages up to max_depth hops (same host by default), "
                 "and returns merged grounded context_items."
             ),
             "inputSchema": {
@@ -562,6 +2912,13 @@ def mcp_tools_payload() -> List[Dict[str, Any]]:
                     "max_urls": {"type": "number", "default": 4},
                     "max_chars_per_url": {"type": "number", "default": 2200},
                     "allow_external": {"type": "boolean", "default": False},
+                    "max_depth": {"type": "number", "default": 2},
+                    "max_pages": {"type": "number"},
+                    "time_budget_seconds": {"type": "number", "default": 20},
+                    "query": {"type": "string"},
+                    "use_sitemap": {"type": "boolean", "default": False},
+                    "budget_tokens": {"type": "number"},
+                    "debug_timings": {"type": "boolean", "default": False},
                 },
                 "required": ["url"],
             },
@@ -594,15 +2951,171 @@ def current_date_context() -> Dict[str, str]:
     }
 
 
+def metric_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels.items():
+        text = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{text}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def render_metrics() -> str:
+    families: List[tuple] = []
+
+    def family(name: str, kind: str, help_text: str, samples: List[tuple]) -> None:
+        families.append((name, kind, help_text, samples))
+
+    family(
+        "mcp_tool_requests_total",
+        "counter",
+        "Tool invocations by outcome.",
+        [("mcp_tool_requests_total", {"tool": tool, "outcome": outcome}, n) for (tool, outcome), n in sorted(TOOL_REQUESTS.items())],
+    )
+    family(
+        "mcp_tool_in_flight",
+        "gauge",
+        "Tool invocations currently running.",
+        [("mcp_tool_in_flight", {"tool": tool}, n) for tool, n in sorted(TOOL_IN_FLIGHT.items())],
+    )
+    family("mcp_tool_latency_seconds", "histogram", "Tool latency.", TOOL_LATENCY.samples("mcp_tool_latency_seconds", ("tool",)))
+    family("mcp_stage_latency_seconds", "histogram", "Latency of internal stages.", STAGE_LATENCY.samples("mcp_stage_latency_seconds", ("stage",)))
+    family(
+        "mcp_upstream_requests_total",
+        "counter",
+        "Upstream HTTP attempts by status (error = transport failure, circuit_open = rejected).",
+        [
+            ("mcp_upstream_requests_total", {"upstream": upstream, "status": status}, n)
+            for (upstream, status), n in sorted(UPSTREAM_REQUESTS.items())
+        ],
+    )
+    family(
+        "mcp_upstream_latency_seconds",
+        "histogram",
+        "Upstream attempt latency including body read.",
+        UPSTREAM_LATENCY.samples("mcp_upstream_latency_seconds", ("upstream",)),
+    )
+    family(
+        "mcp_upstream_bytes_total",
+        "counter",
+        "Bytes downloaded from upstreams.",
+        [("mcp_upstream_bytes_total", {"upstream": upstream}, n) for upstream, n in sorted(UPSTREAM_BYTES.items())],
+    )
+    outbound = outbound_stats()
+    family(
+        "mcp_upstream_in_flight",
+        "gauge",
+        "Outbound requests holding a connection slot.",
+        [("mcp_upstream_in_flight", {"upstream": upstream}, row["in_flight"]) for upstream, row in sorted(outbound.items())],
+    )
+    family(
+        "mcp_upstream_queued",
+        "gauge",
+        "Outbound requests waiting for a connection slot.",
+        [("mcp_upstream_queued", {"upstream": upstream}, row["queued"]) for upstream, row in sorted(outbound.items())],
+    )
+    family(
+        "mcp_circuit_open",
+        "gauge",
+        "1 when the upstream circuit breaker is not closed.",
+        [("mcp_circuit_open", {"upstream": name}, int(breaker.state != "closed")) for name, breaker in sorted(CIRCUIT_BREAKERS.items())],
+    )
+    caches = {
+        "searx": SEARX_CACHE.stats(),
+        "pages": PAGE_CACHE.stats(),
+        "github_meta": GITHUB_META_CACHE.stats(),
+        "github_blobs": GITHUB_BLOB_CACHE.stats(),
+        "sitemaps": SITEMAP_CACHE.stats(),
+    }
+    for field, kind, help_text in (
+        ("hits", "counter", "Cache hits."),
+        ("misses", "counter", "Cache misses."),
+        ("evictions", "counter", "Cache evictions."),
+        ("hit_rate", "gauge", "Cache hit ratio since start."),
+        ("entries", "gauge", "Cache entries."),
+    ):
+        name = f"mcp_cache_{field}" + ("_total" if kind == "counter" else "")
+        family(name, kind, help_text, [(name, {"cache": cache}, row[field]) for cache, row in caches.items()])
+    family(
+        "mcp_cache_bytes",
+        "gauge",
+        "Bytes held by byte-budgeted caches.",
+        [("mcp_cache_bytes", {"cache": cache}, row["bytes"]) for cache, row in caches.items() if "bytes" in row],
+    )
+    family(
+        "mcp_github_cache_total",
+        "counter",
+        "GitHub conditional-request cache outcomes.",
+        [("mcp_github_cache_total", {"result": result}, n) for result, n in GITHUB_CACHE_STATS.items()],
+    )
+    flights = {name: flight.stats() for name, flight in SINGLE_FLIGHTS.items()}
+    family(
+        "mcp_single_flight_coalesced_total",
+        "counter",
+        "Callers that joined an in-flight identical request.",
+        [("mcp_single_flight_coalesced_total", {"flight": name}, row["coalesced"]) for name, row in flights.items()],
+    )
+    family(
+        "mcp_single_flight_in_flight",
+        "gauge",
+        "Distinct keys currently being fetched.",
+        [("mcp_single_flight_in_flight", {"flight": name}, row["in_flight"]) for name, row in flights.items()],
+    )
+    family(
+        "mcp_retry_budget_denied_total",
+        "counter",
+        "Retries refused by the global retry budget.",
+        [("mcp_retry_budget_denied_total", {}, RETRY_BUDGET.denied)],
+    )
+    family("mcp_event_loop_lag_seconds", "histogram", "Event loop wake-up delay.", EVENT_LOOP_LAG.samples("mcp_event_loop_lag_seconds", ()))
+    family(
+        "mcp_event_loop_lag_last_seconds",
+        "gauge",
+        "Most recent event loop lag sample.",
+        [("mcp_event_loop_lag_last_seconds", {}, EVENT_LOOP_LAG_LAST["seconds"])],
+    )
+
+    lines: List[str] = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample_name, labels, value in samples:
+            lines.append(f"{sample_name}{metric_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/health")
 async def health() -> Dict[str, Any]:
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            r = await client.get(f"{SEARX_BASE}/search", params={"q": "health", "format": "json"})
+        r = await upstream_get("searxng", f"{SEARX_BASE}/search", params={"q": "health", "format": "json"}, timeout=10)
         searx_ok = r.status_code == 200
     except Exception:
         searx_ok = False
-    return {"ok": True, "service": "mcp-tools", "searxng": searx_ok, "current_date": current_date_context()}
+    return {
+        "ok": True,
+        "service": "mcp-tools",
+        "searxng": searx_ok,
+        "http_pools": http_pool_stats(),
+        "outbound": outbound_stats(),
+        "breakers": {name: breaker.stats() for name, breaker in CIRCUIT_BREAKERS.items()},
+        "retry_budget": RETRY_BUDGET.stats(),
+        "caches": {
+            "searx": SEARX_CACHE.stats(),
+            "pages": PAGE_CACHE.stats(),
+            "github_meta": GITHUB_META_CACHE.stats(),
+            "github_blobs": GITHUB_BLOB_CACHE.stats(),
+            "github": dict(GITHUB_CACHE_STATS),
+            "sitemaps": SITEMAP_CACHE.stats(),
+        },
+        "single_flight": {name: flight.stats() for name, flight in SINGLE_FLIGHTS.items()},
+        "current_date": current_date_context(),
+    }
 
 
 @app.get("/tools")
@@ -611,27 +3124,32 @@ async def tools() -> Dict[str, Any]:
 
 
 @app.post("/tools/search_quick")
+@instrumented_tool("search_quick")
 async def search_quick(payload: SearchInput) -> Dict[str, Any]:
+    begin_request_budget()
     query_list = collect_queries(payload.query, payload.queries)
     if not query_list and not payload.urls:
         raise HTTPException(status_code=400, detail="provide 'query' or non-empty 'queries'")
 
-    explicit_urls = unique_urls(payload.urls)
-    cleaned_queries: List[str] = []
-    for q in query_list:
-        split = split_query_and_urls(q)
-        cleaned = split["query"]
-        if cleaned:
-            cleaned_queries.append(cleaned)
-        explicit_urls.extend(split["urls"])
-    explicit_urls = unique_urls(explicit_urls)
-
-    repo_scopes = github_scope_urls(explicit_urls)
-    scoped_queries = build_repo_scoped_queries(cleaned_queries, repo_scopes) if repo_scopes else cleaned_queries
+    with trace_span("query_split") as span:
+        explicit_urls = unique_urls(payload.urls)
+        cleaned_queries: List[str] = []
+        for q in query_list:
+            split = split_query_and_urls(q)
+            cleaned = split["query"]
+            if cleaned:
+                cleaned_queries.append(cleaned)
+            explicit_urls.extend(split["urls"])
+        explicit_urls = unique_urls(explicit_urls)
+
+        repo_scopes = github_scope_urls(explicit_urls)
+        scoped_queries = build_repo_scoped_queries(cleaned_queries, repo_scopes) if repo_scopes else cleaned_queries
+        if span is not None:
+            span.update(queries=len(scoped_queries), urls=len(explicit_urls), repo_scopes=len(repo_scopes))
     primary_query = scoped_queries[0] if scoped_queries else ""
     results: List[Dict[str, Any]] = []
     if primary_query:
-        results = await searx_search(primary_query, "general", payload.limit)
+        results = await searx_search(primary_query, "general", payload.limit, bypass_cache=payload.no_cache)
     strict_repo_only = bool(payload.strict_repo_only and repo_scopes)
     if repo_scopes:
         filtered = filter_results_by_github_scope(results, repo_scopes)
@@ -640,20 +3158,27 @@ async def search_quick(payload: SearchInput) -> Dict[str, Any]:
         elif filtered:
             # Prefer repo hits, but keep fallback behavior when strict mode is off.
             results = merge_result_rows(filtered + results, payload.limit)
+    results, duplicates = collapse_near_duplicates(results, "content")
 
     context_items: List[Dict[str, Any]] = []
     effective_include_context = bool(payload.include_context or explicit_urls)
     if effective_include_context and payload.context_max_urls > 0:
         url_pool = explicit_urls + [r.get("url", "") for r in results if r.get("url")]
-        context_items = await fetch_context_items(url_pool, payload.context_max_urls, payload.context_max_chars)
-        for scope in repo_scopes:
-            repo_ctx = await fetch_github_repo_context(
-                scope["owner"],
-                scope["repo"],
-                max_files=min(10, payload.context_max_urls * 3),
-                max_chars_per_file=min(2000, payload.context_max_chars),
-            )
-            context_items.extend(repo_ctx)
+        context_items = await gather_context_with_repos(
+            url_pool,
+            payload.context_max_urls,
+            payload.context_max_chars,
+            repo_scopes,
+            repo_max_files=min(10, payload.context_max_urls * 3),
+            repo_max_chars=min(2000, payload.context_max_chars),
+            query=" ".join(cleaned_queries),
+        )
+        context_items, context_duplicates = collapse_near_duplicates(context_items, "context")
+        duplicates.extend(context_duplicates)
+    budget = context_budget(payload.budget_tokens)
+    budget_stats = None
+    if budget and context_items:
+        context_items, budget_stats = pack_context_items(context_items, budget, " ".join(cleaned_queries))
     if repo_scopes:
         results = merge_result_rows(results + context_items_to_results(context_items, payload.limit), payload.limit)
 
@@ -665,6 +3190,8 @@ async def search_quick(payload: SearchInput) -> Dict[str, Any]:
         "results": results,
         "urls_detected": explicit_urls,
         "context_items": context_items,
+        "duplicates_collapsed": duplicates,
+        **({"context_budget": budget_stats} if budget_stats else {}),
         "repo_scope_enforced": bool(repo_scopes),
         "strict_repo_only": strict_repo_only,
         "repo_scopes": repo_scopes,
@@ -678,7 +3205,9 @@ async def search_quick(payload: SearchInput) -> Dict[str, Any]:
 
 
 @app.post("/tools/search_deep")
+@instrumented_tool("search_deep")
 async def search_deep(payload: DeepSearchInput) -> Dict[str, Any]:
+    begin_request_budget()
     query_list = collect_queries(payload.query, payload.queries)
     if not query_list and not payload.urls:
         raise HTTPException(status_code=400, detail="provide 'query' or non-empty 'queries'")
@@ -688,55 +3217,91 @@ async def search_deep(payload: DeepSearchInput) -> Dict[str, Any]:
     queries_used: List[str] = []
     explicit_urls = unique_urls(payload.urls)
 
-    cleaned_queries: List[str] = []
-    for query in query_list:
-        split = split_query_and_urls(query)
-        explicit_urls.extend(split["urls"])
-        cleaned = split["query"]
-        if cleaned:
-            cleaned_queries.append(cleaned)
-
-    explicit_urls = unique_urls(explicit_urls)
-    repo_scopes = github_scope_urls(explicit_urls)
-    scoped_queries = build_repo_scoped_queries(cleaned_queries, repo_scopes) if repo_scopes else cleaned_queries
+    with trace_span("query_split") as span:
+        cleaned_queries: List[str] = []
+        for query in query_list:
+            split = split_query_and_urls(query)
+            explicit_urls.extend(split["urls"])
+            cleaned = split["query"]
+            if cleaned:
+                cleaned_queries.append(cleaned)
+
+        explicit_urls = unique_urls(explicit_urls)
+        repo_scopes = github_scope_urls(explicit_urls)
+        scoped_queries = build_repo_scoped_queries(cleaned_queries, repo_scopes) if repo_scopes else cleaned_queries
+        if span is not None:
+            span.update(queries=len(scoped_queries), urls=len(explicit_urls), repo_scopes=len(repo_scopes))
     effective_lanes = ["general", "it"] if repo_scopes else lanes
     strict_repo_only = bool(payload.strict_repo_only and repo_scopes)
 
-    for query in scoped_queries:
-        queries_used.append(query)
-        tasks = [searx_search(query, lane, max(3, payload.limit)) for lane in effective_lanes]
-        lane_results = await asyncio.gather(*tasks, return_exceptions=True)
-        for rows in lane_results:
-            if isinstance(rows, Exception):
+    # Schedule every (query, lane) search at once, then merge in the original
+    # query-major/lane-minor order so dedup and matched_query stay deterministic.
+    # Each list also feeds reciprocal rank fusion: a URL ranked in several lists
+    # accumulates 1 / (rrf_k + rank) from each of them.
+    searches = [(query, lane) for query in scoped_queries for lane in effective_lanes]
+    lane_results = await gather_bounded(
+        [searx_search(query, lane, max(3, payload.limit), bypass_cache=payload.no_cache) for query, lane in searches],
+        SEARCH_FANOUT_CONCURRENCY,
+    )
+    queries_used.extend(scoped_queries)
+    rrf_k = float(payload.rrf_k)
+    by_key: Dict[str, Dict[str, Any]] = {}
+    fused: Dict[int, float] = {}
+    for (query, lane), rows in zip(searches, lane_results):
+        if isinstance(rows, Exception):
+            continue
+        for rank, row in enumerate(rows, start=1):
+            key = result_key(row)
+            if not key:
                 continue
-            for row in rows:
-                key = (row.get("url") or row.get("title") or "").strip().lower()
-                if not key or key in seen:
-                    continue
+            if key not in seen:
                 seen.add(key)
                 row["matched_query"] = query
+                row["lane_ranks"] = []
+                by_key[key] = row
                 merged.append(row)
-
-    if repo_scopes:
-        filtered = filter_results_by_github_scope(merged, repo_scopes)
+            kept = by_key[key]
+            kept["lane_ranks"].append({"query": query, "lane": lane, "rank": rank})
+            fused[id(kept)] = fused.get(id(kept), 0.0) + 1.0 / (rrf_k + rank)
+
+    # Re-rank the whole candidate set before truncation so strong hits from later
+    # lanes are not cut: the BM25 ordering joins the lane lists as one more RRF
+    # input. In-scope repo rows stay ahead (stable partition).
+    with trace_span("rank", candidates=len(merged)):
+        in_scope = {id(row) for row in filter_results_by_github_scope(merged, repo_scopes)} if repo_scopes else set()
         if strict_repo_only:
-            merged = filtered
-        elif filtered:
-            merged = filtered + merged
+            merged = [row for row in merged if id(row) in in_scope]
+        scores = bm25_scores(merged, cleaned_queries or scoped_queries)
+        bm25_order = sorted((i for i in range(len(merged)) if scores[i] > 0), key=lambda i: (-scores[i], i))
+        for rank, i in enumerate(bm25_order, start=1):
+            fused[id(merged[i])] = fused.get(id(merged[i]), 0.0) + 1.0 / (rrf_k + rank)
+            merged[i]["bm25_rank"] = rank
+        for row, score in zip(merged, scores):
+            row["bm25"] = round(score, 4)
+            row["rrf"] = round(fused.get(id(row), 0.0), 6)
+        order = sorted(range(len(merged)), key=lambda i: (id(merged[i]) not in in_scope, -fused.get(id(merged[i]), 0.0), i))
+        merged = [merged[i] for i in order]
+    merged, duplicates = collapse_near_duplicates(merged, "content")
     merged = merged[: payload.limit * max(1, len(effective_lanes)) * max(1, len(scoped_queries) or 1)]
 
     context_items: List[Dict[str, Any]] = []
     if payload.include_context and payload.context_max_urls > 0:
         urls = explicit_urls + [r.get("url", "") for r in merged if r.get("url")]
-        context_items = await fetch_context_items(urls, payload.context_max_urls, payload.context_max_chars)
-        for scope in repo_scopes:
-            repo_ctx = await fetch_github_repo_context(
-                scope["owner"],
-                scope["repo"],
-                max_files=min(12, payload.context_max_urls * 3),
-                max_chars_per_file=min(2400, payload.context_max_chars),
-            )
-            context_items.extend(repo_ctx)
+        context_items = await gather_context_with_repos(
+            urls,
+            payload.context_max_urls,
+            payload.context_max_chars,
+            repo_scopes,
+            repo_max_files=min(12, payload.context_max_urls * 3),
+            repo_max_chars=min(2400, payload.context_max_chars),
+            query=" ".join(cleaned_queries),
+        )
+        context_items, context_duplicates = collapse_near_duplicates(context_items, "context")
+        duplicates.extend(context_duplicates)
+    budget = context_budget(payload.budget_tokens)
+    budget_stats = None
+    if budget and context_items:
+        context_items, budget_stats = pack_context_items(context_items, budget, " ".join(cleaned_queries))
     if repo_scopes:
         merged = merge_result_rows(merged + context_items_to_results(context_items, payload.limit * max(1, len(effective_lanes))), payload.limit * max(1, len(effective_lanes)))
 
@@ -748,6 +3313,8 @@ async def search_deep(payload: DeepSearchInput) -> Dict[str, Any]:
         "results": merged,
         "urls_detected": explicit_urls,
         "context_items": context_items,
+        "duplicates_collapsed": duplicates,
+        **({"context_budget": budget_stats} if budget_stats else {}),
         "repo_scope_enforced": bool(repo_scopes),
         "strict_repo_only": strict_repo_only,
         "repo_scopes": repo_scopes,
@@ -761,101 +3328,128 @@ async def search_deep(payload: DeepSearchInput) -> Dict[str, Any]:
 
 
 @app.post("/tools/fetch_url_context")
+@instrumented_tool("fetch_url_context")
 async def fetch_url_context(payload: FetchInput) -> Dict[str, Any]:
+    begin_request_budget()
     validate_http_url(payload.url)
     max_urls = max(1, int(payload.max_urls))
     max_chars = max(500, int(payload.max_chars_per_url))
+    query = payload.query or ""
     repo_target = parse_github_target(payload.url)
     if repo_target:
-        items = await fetch_github_target_context(payload.url, max_urls=max_urls, max_chars_per_url=max_chars)
-        merged = "\n\n".join(
-            [f"URL: {it.get('url','')}\n{it.get('context','')}" for it in items if it.get("context")]
-        ).strip()
+        items = await fetch_github_target_context(payload.url, max_urls=max_urls, max_chars_per_url=max_chars, query=query)
+        budget = context_budget(payload.budget_tokens)
+        budget_stats = None
+        if budget:
+            items, budget_stats = pack_context_items(items, budget, query)
         return {
             "url": payload.url,
             "mode": "repo-aware",
             "source": "github-repo-context",
-            "context": compact_text(merged, min(20000, max_chars * max_urls)),
+            # Without a budget, keep the historical cap on the merged text only.
+            "context": merged_context_text(items, 0 if budget_stats else min(20000, max_chars * max_urls)),
             "context_items": items,
             "count": len(items),
+            **({"context_budget": budget_stats} if budget_stats else {}),
             "current_date": current_date_context(),
         }
     try:
-        text = await fetch_clean_context(payload.url, max_chars)
+        page = await fetch_page_text(payload.url, 0 if query else max_chars)
+    except FetchSkipped as skip:
         return {
             "url": payload.url,
             "mode": "single-url",
-            "context": text,
-            "source": "jina-mirror",
+            "context": "",
+            "source": "none",
+            "skipped": skip.reason,
             "current_date": current_date_context(),
         }
-    except Exception as first_err:
-        try:
-            text = await fetch_direct_context(payload.url, max_chars)
-            return {
-                "url": payload.url,
-                "mode": "single-url",
-                "context": text,
-                "source": "direct-http",
-                "current_date": current_date_context(),
-            }
-        except Exception as second_err:
-            return {
-                "url": payload.url,
-                "mode": "single-url",
-                "context": "",
-                "source": "none",
-                "error": f"url_context_failed: {first_err}; fallback_failed: {second_err}",
-                "current_date": current_date_context(),
-            }
+    except HTTPException as err:
+        return {
+            "url": payload.url,
+            "mode": "single-url",
+            "context": "",
+            "source": "none",
+            "error": str(err.detail),
+            "current_date": current_date_context(),
+        }
+    out = {
+        "url": payload.url,
+        "mode": "single-url",
+        "context": compact_text(page["text"], max_chars, query),
+        "source": page["source"],
+        "current_date": current_date_context(),
+    }
+    budget = context_budget(payload.budget_tokens)
+    if budget:
+        packed, out["context_budget"] = pack_context_items([{"url": payload.url, "context": out["context"]}], budget, query)
+        out["context"] = packed[0]["context"] if packed else ""
+    if page["truncated"]:
+        out["truncated"] = page["truncated"]
+    if page.get("source_timings"):
+        out["source_timings"] = page["source_timings"]
+    return out
 
 
 @app.post("/tools/fetch_url_context_smart")
+@instrumented_tool("fetch_url_context_smart")
 async def fetch_url_context_smart(payload: SmartFetchInput) -> Dict[str, Any]:
+    begin_request_budget()
     validate_http_url(payload.url)
     max_urls = max(1, int(payload.max_urls))
     max_chars = max(500, int(payload.max_chars_per_url))
+    query = payload.query or ""
 
     items: List[Dict[str, Any]] = []
     visited: List[str] = []
-
-    primary = await fetch_context_with_fallback(payload.url, max_chars)
-    items.append(primary)
-    visited.append(payload.url)
+    crawl_stats: Optional[Dict[str, Any]] = None
+    duplicates: List[Dict[str, Any]] = []
 
     repo = parse_github_repo(payload.url)
     if repo:
+        items.append(await fetch_context_with_fallback(payload.url, max_chars, query))
+        visited.append(payload.url)
         repo_ctx = await fetch_github_repo_context(
             repo["owner"],
             repo["repo"],
             max_files=min(24, max_urls * 4),
             max_chars_per_file=max_chars,
+            query=query,
         )
         for c in repo_ctx:
-            items.append({"url": c.get("url", ""), "context": c.get("context", ""), "source": "github-repo"})
+            items.append({**c, "source": "github-repo"})
             if len(items) >= max_urls:
                 break
     else:
-        link_budget = max(0, max_urls - 1)
-        links = extract_links_from_text(payload.url, str(primary.get("context", "")), link_budget, payload.allow_external)
-        tasks = [fetch_context_with_fallback(u, max_chars) for u in links]
-        if tasks:
-            fetched = await asyncio.gather(*tasks, return_exceptions=True)
-            for u, entry in zip(links, fetched):
-                visited.append(u)
-                if isinstance(entry, Exception):
-                    items.append({"url": u, "context": "", "source": "none", "error": str(entry)})
-                else:
-                    items.append(entry)
-
-    merged = "\n\n".join([f"URL: {it.get('url','')}\n{it.get('context','')}" for it in items if it.get("context")]).strip()
+        max_pages = payload.max_pages or min(60, max_urls * 3)
+        crawl = await crawl_site(
+            payload.url,
+            max_urls=max_urls,
+            max_chars=max_chars,
+            max_depth=payload.max_depth,
+            max_pages=max_pages,
+            time_budget=payload.time_budget_seconds,
+            allow_external=payload.allow_external,
+            query=query,
+            discovery=sitemap_discovery(payload.url, query, max_pages) if payload.use_sitemap else None,
+        )
+        visited = crawl["visited"]
+        crawl_stats = crawl["stats"]
+        items, duplicates = collapse_near_duplicates(crawl["items"], "context")
+    budget = context_budget(payload.budget_tokens)
+    budget_stats = None
+    if budget:
+        items, budget_stats = pack_context_items(items, budget, query)
     return {
         "url": payload.url,
         "mode": "smart",
         "urls_visited": visited,
         "count": len(items),
         "context_items": items,
-        "merged_context": compact_text(merged, min(20000, max_chars * max_urls)),
+        "merged_context": merged_context_text(items, 0 if budget_stats else min(20000, max_chars * max_urls)),
+        "duplicates_collapsed": duplicates,
+        **({"context_budget": budget_stats} if budget_stats else {}),
+        **({"crawl": crawl_stats} if crawl_stats else {}),
         "current_date": current_date_context(),
     }
 
@@ -888,70 +3482,72 @@ async def mcp_info() -> Dict[str, Any]:
     }
 
 
-@app.post("/mcp")
-async def mcp_http(request: Request) -> Response:
+async def handle_mcp_message(raw: Any) -> Optional[Dict[str, Any]]:
     try:
-        payload = await request.json()
+        msg = JsonRpcRequest(**raw)
     except Exception:
-        return JSONResponse(mcp_error(None, -32700, "Parse error"), status_code=400)
+        return mcp_error(raw.get("id") if isinstance(raw, dict) else None, -32600, "Invalid Request")
 
-    is_batch = isinstance(payload, list)
-    req_items = payload if is_batch else [payload]
-    responses: List[Dict[str, Any]] = []
+    if msg.method == "initialize":
+        result = {
+            "protocolVersion": MCP_PROTOCOL_VERSION,
+            "capabilities": {"tools": {"listChanged": False}},
+            "serverInfo": {"name": "appagent-mcp-http", "version": "1.0.0"},
+        }
+        return mcp_ok(msg.id, result)
 
-    for raw in req_items:
-        try:
-            msg = JsonRpcRequest(**raw)
-        except Exception:
-            responses.append(mcp_error(raw.get("id") if isinstance(raw, dict) else None, -32600, "Invalid Request"))
-            continue
+    if msg.method == "notifications/initialized":
+        return None
 
-        if msg.method == "initialize":
-            result = {
-                "protocolVersion": MCP_PROTOCOL_VERSION,
-                "capabilities": {"tools": {"listChanged": False}},
-                "serverInfo": {"name": "appagent-mcp-http", "version": "1.0.0"},
-            }
-            responses.append(mcp_ok(msg.id, result))
-            continue
+    if msg.method == "ping":
+        return mcp_ok(msg.id, {})
 
-        if msg.method == "notifications/initialized":
-            continue
+    if msg.method == "tools/list":
+        return mcp_ok(msg.id, {"tools": mcp_tools_payload(), "current_date": current_date_context()})
 
-        if msg.method == "ping":
-            responses.append(mcp_ok(msg.id, {}))
-            continue
+    if msg.method == "tools/call":
+        tool_name = msg.params.get("name")
+        tool_args = msg.params.get("arguments", {})
+        if not tool_name:
+            return mcp_error(msg.id, -32602, "Missing tool name")
+        try:
+            result_data = await mcp_call(ToolCall(tool=tool_name, arguments=tool_args))
+        except HTTPException as e:
+            return mcp_error(msg.id, -32000, str(e.detail))
+        except Exception as e:
+            return mcp_error(msg.id, -32000, str(e))
+        return mcp_ok(
+            msg.id,
+            {
+                "content": [{"type": "text", "text": json.dumps(result_data, ensure_ascii=False)}],
+                "isError": False,
+            },
+        )
 
-        if msg.method == "tools/list":
-            responses.append(mcp_ok(msg.id, {"tools": mcp_tools_payload(), "current_date": current_date_context()}))
-            continue
+    return mcp_error(msg.id, -32601, f"Method not found: {msg.method}")
 
-        if msg.method == "tools/call":
-            tool_name = msg.params.get("name")
-            tool_args = msg.params.get("arguments", {})
-            if not tool_name:
-                responses.append(mcp_error(msg.id, -32602, "Missing tool name"))
-                continue
-            try:
-                result_data = await mcp_call(ToolCall(tool=tool_name, arguments=tool_args))
-            except HTTPException as e:
-                responses.append(mcp_error(msg.id, -32000, str(e.detail)))
-                continue
-            except Exception as e:
-                responses.append(mcp_error(msg.id, -32000, str(e)))
-                continue
-            responses.append(
-                mcp_ok(
-                    msg.id,
-                    {
-                        "content": [{"type": "text", "text": json.dumps(result_data, ensure_ascii=False)}],
-                        "isError": False,
-                    },
-                )
-            )
-            continue
 
-        responses.append(mcp_error(msg.id, -32601, f"Method not found: {msg.method}"))
+@app.post("/mcp")
+async def mcp_http(request: Request) -> Response:
+    try:
+        payload = await request.json()
+    except Exception:
+        return JSONResponse(mcp_error(None, -32700, "Parse error"), status_code=400)
+
+    is_batch = isinstance(payload, list)
+    req_items = payload if is_batch else [payload]
+    token = REQUEST_MEMO.set({})
+    try:
+        # Batch items run concurrently but responses keep request order.
+        handled = await gather_bounded([handle_mcp_message(raw) for raw in req_items], BATCH_CONCURRENCY)
+    finally:
+        REQUEST_MEMO.reset(token)
+    responses: List[Dict[str, Any]] = []
+    for raw, res in zip(req_items, handled):
+        if isinstance(res, BaseException):
+            res = mcp_error(raw.get("id") if isinstance(raw, dict) else None, -32603, f"Internal error: {res}")
+        if res is not None:
+            responses.append(res)
 
     if not responses:
         return Response(status_code=204)
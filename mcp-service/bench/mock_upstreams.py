@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+from typing import Any, Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+
+# Local stand-ins for every upstream the service talks to, served from one
+# process under path prefixes:
+#   /searx/search         SearXNG JSON API        (SEARX_BASE=<mock>/searx)
+#   /jina/http://...      r.jina.ai markdown      (MCP_JINA_BASE=<mock>/jina)
+#   /github-api/repos/... GitHub REST repo + tree (MCP_GITHUB_API_BASE=<mock>/github-api)
+#   /github-raw/...       raw.githubusercontent   (MCP_GITHUB_RAW_BASE=<mock>/github-raw)
+#   /site/...             HTML pages for direct fetches (search results point here)
+# Latency, jitter, error rate and payload size are set per upstream via
+# POST /_config and counted per upstream in GET /_stats.
+
+UPSTREAMS = ("searxng", "jina", "github_api", "github_raw", "direct")
+DEFAULT_UPSTREAM_CONFIG: Dict[str, Any] = {
+    "latency_ms": 40.0,
+    "jitter_ms": 10.0,
+    "error_rate": 0.0,
+    "error_status": 503,
+    "payload_bytes": 12000,
+}
+DEFAULT_CONFIG: Dict[str, Any] = {
+    "seed": 1,
+    "search_results": 10,
+    # Share of search results that point at a GitHub repo instead of /site pages.
+    "github_result_ratio": 0.2,
+    "github_repos": 4,
+    "github_tree_files": 24,
+    "links_per_page": 20,
+    "upstreams": {name: dict(DEFAULT_UPSTREAM_CONFIG) for name in UPSTREAMS},
+}
+DEFAULT_CONFIG["upstreams"]["searxng"]["payload_bytes"] = 0
+DEFAULT_CONFIG["upstreams"]["github_api"]["payload_bytes"] = 0
+
+VOCABULARY = [
+    f"{a}{b}"
+    for a in ("cache", "async", "route", "token", "index", "query", "crawl", "batch", "proxy", "shard")
+    for b in ("", "er", "ing", "ed", "s", "able", "ly", "ness", "ment", "ion")
+]
+
+app = FastAPI(title="MCP benchmark upstream mocks")
+CONFIG: Dict[str, Any] = json.loads(json.dumps(DEFAULT_CONFIG))
+STATS: Dict[str, Dict[str, int]] = {}
+
+
+def reset_stats() -> None:
+    STATS.clear()
+    for name in UPSTREAMS:
+        STATS[name] = {"requests": 0, "errors": 0, "not_modified": 0, "bytes": 0}
+
+
+reset_stats()
+
+
+def merge_config(update: Dict[str, Any]) -> None:
+    for key, value in update.items():
+        if key == "upstreams":
+            for name, row in value.items():
+                CONFIG["upstreams"].setdefault(name, dict(DEFAULT_UPSTREAM_CONFIG)).update(row)
+        else:
+            CONFIG[key] = value
+
+
+def seeded(*parts: Any) -> random.Random:
+    digest = hashlib.blake2b(repr((CONFIG["seed"],) + parts).encode("utf-8"), digest_size=8).digest()
+    return random.Random(int.from_bytes(digest, "big"))
+
+
+def filler_text(seed: str, size: int, topic: str = "") -> str:
+    # Deterministic per seed but distinct across seeds, so duplicate collapsing
+    # does not fold every mock page into one.
+    rng = seeded("text", seed)
+    topic_words = [w for w in topic.lower().split() if w.isalnum()][:6]
+    words: List[str] = []
+    length = 0
+    while length < size:
+        sentence = [rng.choice(VOCABULARY) for _ in range(rng.randint(8, 18))]
+        if topic_words and rng.random() < 0.3:
+            sentence.insert(rng.randint(0, len(sentence)), rng.choice(topic_words))
+        line = " ".join(sentence).capitalize() + "."
+        words.append(line)
+        length += len(line) + 1
+    return " ".join(words)[: max(0, size)]
+
+
+async def simulate(upstream: str) -> Any:
+    # Returns an error response to send instead of the real one, or None.
+    cfg = CONFIG["upstreams"][upstream]
+    stats = STATS[upstream]
+    stats["requests"] += 1
+    delay = float(cfg["latency_ms"]) + random.uniform(-1.0, 1.0) * float(cfg["jitter_ms"])
+    if delay > 0:
+        await asyncio.sleep(delay / 1000.0)
+    if random.random() < float(cfg["error_rate"]):
+        stats["errors"] += 1
+        return PlainTextResponse("mock upstream error", status_code=int(cfg["error_status"]))
+    return None
+
+
+def sent(upstream: str, response: Response) -> Response:
+    STATS[upstream]["bytes"] += len(response.body)
+    return response
+
+
+def site_url(request: Request, path: str) -> str:
+    return f"{str(request.base_url).rstrip('/')}/site/{path.lstrip('/')}"
+
+
+@app.get("/searx/search")
+async def searx_search(request: Request, q: str = "", categories: str = "general") -> Response:
+    failed = await simulate("searxng")
+    if failed is not None:
+        return failed
+    rng = seeded("search", q, categories)
+    results = []
+    for i in range(int(CONFIG["search_results"])):
+        if rng.random() < float(CONFIG["github_result_ratio"]):
+            repo = rng.randrange(max(1, int(CONFIG["github_repos"])))
+            url = f"https://github.com/bench/repo{repo}"
+        else:
+            url = site_url(request, f"{categories}/{rng.randrange(10**6)}/page-{i}")
+        results.append(
+            {
+                "url": url,
+                "title": f"{q} result {i}",
+                "content": filler_text(f"snippet:{url}", 240, q),
+                "engine": "mock",
+            }
+        )
+    return sent("searxng", JSONResponse({"query": q, "results": results}))
+
+
+def page_links(request: Request, seed: str) -> List[str]:
+    rng = seeded("links", seed)
+    return [site_url(request, f"docs/{rng.randrange(10**6)}/page") for _ in range(int(CONFIG["links_per_page"]))]
+
+
+@app.get("/jina/{target:path}")
+async def jina_mirror(request: Request, target: str) -> Response:
+    failed = await simulate("jina")
+    if failed is not None:
+        return failed
+    size = int(CONFIG["upstreams"]["jina"]["payload_bytes"])
+    links = "\n".join(f"- [Related {i}]({url})" for i, url in enumerate(page_links(request, target)))
+    body = f"Title: {target}\n\nMarkdown Content:\n{filler_text(target, size)}\n\n{links}\n"
+    return sent("jina", PlainTextResponse(body, media_type="text/plain; charset=utf-8"))
+
+
+@app.get("/site/{path:path}")
+async def site_page(request: Request, path: str) -> Response:
+    failed = await simulate("direct")
+    if failed is not None:
+        return failed
+    size = int(CONFIG["upstreams"]["direct"]["payload_bytes"])
+    paragraphs = filler_text(path, size)
+    links = "".join(f'<li><a href="{url}">Related page {i}</a></li>' for i, url in enumerate(page_links(request, path)))
+    body = (
+        f"<!doctype html><html><head><title>{path}</title></head><body>"
+        f"<nav><ul>{links}</ul></nav><main><h1>{path}</h1><p>{paragraphs}</p></main></body></html>"
+    )
+    return sent("direct", Response(body, media_type="text/html; charset=utf-8"))
+
+
+def repo_tree(owner: str, repo: str) -> List[Dict[str, Any]]:
+    rng = seeded("tree", owner, repo)
+    paths = ["README.md", "requirements.txt", "docs/index.md"]
+    while len(paths) < int(CONFIG["github_tree_files"]):
+        folder = rng.choice(("src", "docs", "examples", "tests"))
+        ext = rng.choice((".py", ".md", ".ts", ".json"))
+        paths.append(f"{folder}/{rng.choice(VOCABULARY)}_{len(paths)}{ext}")
+    return [
+        {"path": p, "type": "blob", "sha": hashlib.sha1(f"{owner}/{repo}/{p}".encode()).hexdigest(), "size": 1000}
+        for p in paths
+    ]
+
+
+def github_json(request: Request, data: Any) -> Response:
+    etag = '"' + hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest() + '"'
+    if request.headers.get("if-none-match") == etag:
+        STATS["github_api"]["not_modified"] += 1
+        return Response(status_code=304, headers={"ETag": etag})
+    return sent("github_api", JSONResponse(data, headers={"ETag": etag}))
+
+
+@app.get("/github-api/repos/{owner}/{repo}")
+async def github_repo(request: Request, owner: str, repo: str) -> Response:
+    failed = await simulate("github_api")
+    if failed is not None:
+        return failed
+    return github_json(request, {"full_name": f"{owner}/{repo}", "default_branch": "main"})
+
+
+@app.get("/github-api/repos/{owner}/{repo}/git/trees/{branch}")
+async def github_tree(request: Request, owner: str, repo: str, branch: str) -> Response:
+    failed = await simulate("github_api")
+    if failed is not None:
+        return failed
+    return github_json(request, {"sha": branch, "tree": repo_tree(owner, repo), "truncated": False})
+
+
+@app.get("/github-raw/{owner}/{repo}/{ref}/{path:path}")
+async def github_raw(owner: str, repo: str, ref: str, path: str) -> Response:
+    failed = await simulate("github_raw")
+    if failed is not None:
+        return failed
+    size = int(CONFIG["upstreams"]["github_raw"]["payload_bytes"])
+    return sent("github_raw", PlainTextResponse(f"# {path}\n\n{filler_text(f'{owner}/{repo}/{path}', size)}\n"))
+
+
+@app.get("/_config")
+async def get_config() -> Dict[str, Any]:
+    return CONFIG
+
+
+@app.post("/_config")
+async def set_config(request: Request) -> Dict[str, Any]:
+    # Replaces the configuration with defaults overlaid by the posted object.
+    CONFIG.clear()
+    CONFIG.update(json.loads(json.dumps(DEFAULT_CONFIG)))
+    merge_config(await request.json())
+    return CONFIG
+
+
+@app.get("/_stats")
+async def get_stats() -> Dict[str, Any]:
+    return STATS
+
+
+@app.post("/_stats/reset")
+async def post_stats_reset() -> Dict[str, Any]:
+    reset_stats()
+    return STATS
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve mock SearXNG, jina and GitHub upstreams.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("BENCH_MOCK_PORT", "8091")))
+    parser.add_argument("--config", help="JSON file overlaid on the default mock configuration")
+    args = parser.parse_args()
+    if args.config:
+        with open(args.config, encoding="utf-8") as fh:
+            merge_config(json.load(fh))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_SCENARIOS = os.path.join(BENCH_DIR, "scenarios.json")
+# Regression checks: latency percentiles must not grow, throughput must not drop,
+# by more than the tolerance relative to the baseline run.
+COMPARED_LATENCIES = ("p50", "p95", "p99")
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    # Nearest-rank percentile; 0.0 for an empty sample.
+    if not sorted_values:
+        return 0.0
+    rank = max(1, min(len(sorted_values), int(-(-q * len(sorted_values) // 100))))
+    return sorted_values[rank - 1]
+
+
+def fill(value: Any, names: Dict[str, str]) -> Any:
+    # Substitutes {n}, {scenario} and {mock} in every string of a request template.
+    if isinstance(value, str):
+        for key, text in names.items():
+            value = value.replace("{" + key + "}", text)
+        return value
+    if isinstance(value, list):
+        return [fill(v, names) for v in value]
+    if isinstance(value, dict):
+        return {k: fill(v, names) for k, v in value.items()}
+    return value
+
+
+def build_request(scenario: Dict[str, Any], index: int, mock_url: str) -> tuple:
+    distinct = int(scenario.get("distinct", 0))
+    target = scenario.get("target", "rest")
+    tool = scenario["tool"]
+    batch = max(1, int(scenario.get("batch", 1)))
+
+    def arguments(i: int) -> Dict[str, Any]:
+        n = i % distinct if distinct else i
+        return fill(scenario.get("arguments", {}), {"n": str(n), "scenario": scenario["name"], "mock": mock_url})
+
+    if target == "rest":
+        return f"/tools/{tool}", arguments(index)
+    calls = [
+        {"jsonrpc": "2.0", "id": k, "method": "tools/call", "params": {"name": tool, "arguments": arguments(index * batch + k)}}
+        for k in range(batch)
+    ]
+    return "/mcp", calls if batch > 1 else calls[0]
+
+
+def response_ok(res: httpx.Response, target: str) -> bool:
+    if res.status_code != 200:
+        return False
+    if target == "rest":
+        return True
+    body = res.json()
+    rows = body if isinstance(body, list) else [body]
+    return bool(rows) and all("result" in row and not row["result"].get("isError") for row in rows)
+
+
+def process_memory(pid: Optional[int]) -> Optional[Dict[str, float]]:
+    # Linux /proc only; VmHWM is the peak since the service started.
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as fh:
+            fields = dict(line.split(":", 1) for line in fh if ":" in line)
+    except OSError:
+        return None
+    out = {}
+    for key, name in (("VmRSS", "rss_mb"), ("VmHWM", "peak_rss_mb")):
+        if key in fields:
+            out[name] = round(int(fields[key].split()[0]) / 1024, 1)
+    return out
+
+
+async def run_load(client: httpx.AsyncClient, scenario: Dict[str, Any], mock_url: str, total: int, offset: int) -> Dict[str, Any]:
+    target = scenario.get("target", "rest")
+    concurrency = max(1, int(scenario.get("concurrency", 4)))
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    next_index = [0]
+
+    async def worker() -> None:
+        while next_index[0] < total:
+            i = offset + next_index[0]
+            next_index[0] += 1
+            path, body = build_request(scenario, i, mock_url)
+            started = time.perf_counter()
+            try:
+                res = await client.post(path, json=body)
+                ok = response_ok(res, target)
+                reason = f"http_{res.status_code}" if res.status_code != 200 else "tool_error"
+            except httpx.HTTPError as err:
+                ok = False
+                reason = type(err).__name__
+            elapsed = time.perf_counter() - started
+            if ok:
+                latencies.append(elapsed * 1000)
+            else:
+                errors[reason] = errors.get(reason, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall = time.perf_counter() - started
+    latencies.sort()
+    completed = len(latencies)
+    return {
+        "requests": total,
+        "ok": completed,
+        "errors": errors,
+        "error_rate": round(1 - completed / total, 4) if total else 0.0,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(completed / wall, 2) if wall > 0 else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "mean": round(sum(latencies) / completed, 2) if completed else 0.0,
+            "max": round(latencies[-1], 2) if latencies else 0.0,
+        },
+    }
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    mock: httpx.AsyncClient,
+    scenario: Dict[str, Any],
+    mock_defaults: Dict[str, Any],
+    service_pid: Optional[int],
+) -> Dict[str, Any]:
+    mock_url = str(mock.base_url).rstrip("/")
+    config = json.loads(json.dumps(mock_defaults))
+    for key, value in (scenario.get("mock") or {}).items():
+        if key == "upstreams":
+            for name, row in value.items():
+                config.setdefault("upstreams", {}).setdefault(name, {}).update(row)
+        else:
+            config[key] = value
+    (await mock.post("/_config", json=config)).raise_for_status()
+    warmup = int(scenario.get("warmup", 0))
+    if warmup:
+        await run_load(client, scenario, mock_url, warmup, 0)
+    (await mock.post("/_stats/reset")).raise_for_status()
+    memory_before = process_memory(service_pid)
+    total = int(scenario.get("requests", 50))
+    result = await run_load(client, scenario, mock_url, total, warmup)
+    upstream = (await mock.get("/_stats")).json()
+    calls = {name: row for name, row in upstream.items() if row["requests"]}
+    tool_calls = total * max(1, int(scenario.get("batch", 1)))
+    return {
+        "name": scenario["name"],
+        "target": scenario.get("target", "rest"),
+        "tool": scenario["tool"],
+        "concurrency": int(scenario.get("concurrency", 4)),
+        "batch": int(scenario.get("batch", 1)),
+        "warmup": warmup,
+        **result,
+        "memory": {"before": memory_before, "after": process_memory(service_pid)},
+        "upstream_calls": calls,
+        "upstream_calls_per_tool_call": {name: round(row["requests"] / tool_calls, 3) for name, row in calls.items()},
+    }
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], tolerance: float) -> List[Dict[str, Any]]:
+    previous = {row["name"]: row for row in baseline.get("scenarios", [])}
+    regressions: List[Dict[str, Any]] = []
+    for row in results:
+        old = previous.get(row["name"])
+        if old is None:
+            continue
+        for key in COMPARED_LATENCIES:
+            before, after = old["latency_ms"][key], row["latency_ms"][key]
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append({"scenario": row["name"], "metric": f"latency_ms.{key}", "baseline": before, "current": after})
+        before, after = old["throughput_rps"], row["throughput_rps"]
+        if before > 0 and after < before * (1 - tolerance):
+            regressions.append({"scenario": row["name"], "metric": "throughput_rps", "baseline": before, "current": after})
+        if row["error_rate"] > old["error_rate"] + tolerance / 10:
+            regressions.append(
+                {"scenario": row["name"], "metric": "error_rate", "baseline": old["error_rate"], "current": row["error_rate"]}
+            )
+    return regressions
+
+
+def git_revision() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SERVICE_DIR, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return ""
+    return out.stdout.strip()
+
+
+async def wait_ready(client: httpx.AsyncClient, path: str, process: Optional[subprocess.Popen], timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        if process is not None and process.poll() is not None:
+            raise SystemExit(f"{client.base_url} exited with code {process.returncode}")
+        try:
+            if (await client.get(path)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        if time.monotonic() > deadline:
+            raise SystemExit(f"{client.base_url}{path} not ready after {timeout:.0f}s")
+        await asyncio.sleep(0.2)
+
+
+def start_process(args: List[str], env: Dict[str, str], cwd: str) -> subprocess.Popen:
+    return subprocess.Popen(args, env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop_processes(processes: List[subprocess.Popen]) -> None:
+    for process in reversed(processes):
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def start_service(spec: Dict[str, Any], mock_url: str, port: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "SEARX_BASE": f"{mock_url}/searx",
+        "MCP_JINA_BASE": f"{mock_url}/jina",
+        "MCP_GITHUB_API_BASE": f"{mock_url}/github-api",
+        "MCP_GITHUB_RAW_BASE": f"{mock_url}/github-raw",
+        **{k: str(v) for k, v in (spec.get("service_env") or {}).items()},
+    }
+    return start_process(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env,
+        SERVICE_DIR,
+    )
+
+
+async def main_async(args: argparse.Namespace) -> int:
+    with open(args.scenarios, encoding="utf-8") as fh:
+        spec = json.load(fh)
+    scenarios = [s for s in spec["scenarios"] if not args.only or s["name"] in args.only]
+    if not scenarios:
+        raise SystemExit("no scenarios selected")
+
+    processes: List[subprocess.Popen] = []
+    mock_url = args.mock_url or f"http://127.0.0.1:{args.mock_port}"
+    service_url = args.service_url or f"http://127.0.0.1:{args.service_port}"
+    try:
+        if not args.mock_url:
+            processes.append(
+                start_process(
+                    [sys.executable, os.path.join(BENCH_DIR, "mock_upstreams.py"), "--port", str(args.mock_port)],
+                    dict(os.environ),
+                    BENCH_DIR,
+                )
+            )
+        timeout = httpx.Timeout(args.request_timeout)
+        limits = httpx.Limits(max_connections=256, max_keepalive_connections=256)
+        async with httpx.AsyncClient(base_url=mock_url, timeout=timeout) as mock:
+            await wait_ready(mock, "/_stats", processes[0] if not args.mock_url else None)
+            results = []
+            for scenario in scenarios:
+                # A fresh service per scenario: breakers, caches, mirror latency samples
+                # and the retry budget would otherwise carry over, and results would
+                # depend on which scenarios ran before.
+                service: Optional[subprocess.Popen] = None
+                if not args.service_url:
+                    service = start_service(spec, mock_url, args.service_port)
+                try:
+                    async with httpx.AsyncClient(base_url=service_url, timeout=timeout, limits=limits) as client:
+                        await wait_ready(client, "/tools", service)
+                        row = await run_scenario(
+                            client, mock, scenario, spec.get("mock_defaults") or {}, service.pid if service else None
+                        )
+                finally:
+                    if service is not None:
+                        stop_processes([service])
+                results.append(row)
+                lat = row["latency_ms"]
+                print(
+                    f"{row['name']}: {row['ok']}/{row['requests']} ok, p50 {lat['p50']}ms p95 {lat['p95']}ms "
+                    f"p99 {lat['p99']}ms, {row['throughput_rps']} req/s",
+                    file=sys.stderr,
+                )
+    finally:
+        stop_processes(processes)
+
+    report: Dict[str, Any] = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "scenarios_file": args.scenarios,
+            "service_env": spec.get("service_env") or {},
+        },
+        "scenarios": results,
+    }
+    status = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+        report["baseline"] = {"file": args.baseline, "tolerance": args.tolerance, "regressions": regressions}
+        status = 1 if regressions else 0
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            fh.write(text + "\n")
+    else:
+        print(text)
+    return status
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the MCP tool service against local upstream mocks.")
+    parser.add_argument("--scenarios", default=DEFAULT_SCENARIOS)
+    parser.add_argument("--only", action="append", help="run only the named scenario (repeatable)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="previous JSON report to compare against; exits 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change vs. the baseline")
+    parser.add_argument("--service-url", help="benchmark an already running service instead of starting one")
+    parser.add_argument("--mock-url", help="use an already running mock_upstreams.py")
+    parser.add_argument("--service-port", type=int, default=18090)
+    parser.add_argument("--mock-port", type=int, default=18091)
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    sys.exit(asyncio.run(main_async(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()